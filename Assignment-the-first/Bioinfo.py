@@ -3,6 +3,71 @@ DNA_BASES: set = set('ATGCatcg')
 RNA_BASES: set = set('AUGCaucg')
 
 
+####### Batch functions: #######
+#Batch versions of the sequence/quality functions below, for many sequences at a time (must import numpy first).
+#Each takes a list of sequences (str or bytes), puts all of their bytes into 1 numpy array, and does the per-character work with array operations.
+import numpy as np
+
+def get_seq_block(seqs: list) -> list:
+    '''Takes a list of sequences (all str or all bytes). Returns a list [1D uint8 array of the bytes of all sequences, back to back; 1D array of the start position of each sequence in it; 1D array of the length of each sequence].'''
+    #local variables
+    lengths: np.ndarray = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    starts: np.ndarray = np.cumsum(lengths) - lengths
+    all_bytes: bytes = b""
+
+    if len(seqs) > 0 and isinstance(seqs[0], str):
+        all_bytes = "".join(seqs).encode("ascii")   #joining first means only 1 encode call (sequences are ASCII, so lengths don't change)
+    else:
+        all_bytes = b"".join(seqs)
+    return [np.frombuffer(all_bytes, dtype=np.uint8), starts, lengths]
+
+def sum_per_seq(values: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    '''Takes a 1D array of a value for each byte of a sequence block (see get_seq_block) and returns the sum of the values of each sequence (0 for empty sequences).'''
+    #local variables
+    sums: np.ndarray = np.zeros(len(lengths), dtype=np.int64)
+
+    if len(values) == 0:
+        return sums
+    if (lengths == lengths[0]).all():
+        #all sequences are the same length (e.g. reads from 1 run): each sequence is a row of a matrix
+        return values.reshape(len(lengths), lengths[0]).sum(axis=1, dtype=np.int64)
+    #reduceat sums from each start to the next, so it only gets the starts of non-empty sequences (empty sequences in between have no bytes, and one at the end would have a start past the last byte)
+    sums[lengths > 0] = np.add.reduceat(values, starts[lengths > 0], dtype=np.int64)
+    return sums
+
+def convert_phred_batch(letters) -> np.ndarray:
+    '''Takes a string (or bytes) of phred+33 quality letters and returns a 1D array of the phred score of each letter.'''
+    if isinstance(letters, str):
+        letters = letters.encode("ascii")
+    return np.frombuffer(letters, dtype=np.uint8).astype(np.int64) - 33
+
+def qual_score_batch(phred_scores: list) -> np.ndarray:
+    '''Takes a list of phred+33 quality strings and returns a 1D array of the average quality score of each string (nan for empty strings).'''
+    #local variables
+    qual_bytes, starts, lengths = get_seq_block(phred_scores)
+    score_sums: np.ndarray = sum_per_seq(qual_bytes, starts, lengths) - 33 * lengths
+
+    return np.divide(score_sums, lengths, out=np.full(len(lengths), np.nan), where=lengths > 0)
+
+def validate_DNA_seq_batch(seqs: list) -> np.ndarray:
+    '''Takes a list of sequences and returns a 1D bool array: True for each sequence composed of only As, Ts, Gs, and Cs. Case insensitive.'''
+    #local variables
+    seq_bytes, starts, lengths = get_seq_block(seqs)
+    lower_bytes: np.ndarray = seq_bytes | 32    #sets the lowercase bit, so "A" and "a" (and only those) both become "a", etc
+
+    #a sequence is valid if none of its bytes are something other than a, c, g, or t
+    return sum_per_seq(~((lower_bytes == ord("a")) | (lower_bytes == ord("c")) | (lower_bytes == ord("g")) | (lower_bytes == ord("t"))), starts, lengths) == 0
+
+def gc_content_batch(seqs: list) -> np.ndarray:
+    '''Takes a list of DNA sequences and returns a 1D array of the GC content of each sequence as a decimal between 0 and 1 (nan for empty sequences). Case insensitive.'''
+    #local variables
+    seq_bytes, starts, lengths = get_seq_block(seqs)
+    lower_bytes: np.ndarray = seq_bytes | 32    #sets the lowercase bit, so "G" and "g" (and only those) both become "g", etc
+    gc_counts: np.ndarray = sum_per_seq((lower_bytes == ord("g")) | (lower_bytes == ord("c")), starts, lengths)
+
+    return np.divide(gc_counts, lengths, out=np.full(len(lengths), np.nan), where=lengths > 0)
+
+
 ####### Functions: #######
 def validate_base_seq(seq,RNAflag=False):
     '''This function takes a string. Returns True if string is composed
@@ -13,34 +78,21 @@ def validate_base_seq(seq,RNAflag=False):
 
 def convert_phred(letter: str) -> int:
     """Converts a single character into a phred score"""
-    phred_value = ord(letter) - 33
-    return(phred_value)
+    return int(convert_phred_batch(letter)[0])
 
 def qual_score(phred_score: str) -> float:
-    """Takes an unmodified phred score string of letters, iterates through each letter, converts each letter to a numerical phred value, and calculates the average quality score of the whole phred string."""
-    index = 0
-    converted_score_sum = 0
-    for letter in phred_score:
-        converted_score = convert_phred(phred_score[index])
-        converted_score_sum += converted_score
-        index += 1
-    avg_score = converted_score_sum / len(phred_score)
-    return avg_score
+    """Takes an unmodified phred score string of letters and calculates the average quality score of the whole phred string (see qual_score_batch)."""
+    return float(qual_score_batch([phred_score])[0])
 
 def validate_DNA_seq(seq: str) -> bool:
     '''This function takes a string. Returns True if string is composed
     of only As, Ts, Gs, and Cs. False otherwise. Case insensitive.'''
-    seq = seq.upper()
-    return len(seq) == seq.count("A") + seq.count("T") + seq.count("G")
+    return bool(validate_DNA_seq_batch([seq])[0])
 
 def gc_content(DNA: str) -> float:
     '''Returns GC content of a DNA sequence as a decimal between 0 and 1.'''
     assert validate_DNA_seq(DNA), "String contains invalid characters"
-    
-    DNA = DNA.upper()
-    Gs = DNA.count("G")
-    Cs = DNA.count("C")
-    return (Gs+Cs)/len(DNA)
+    return float(gc_content_batch([DNA])[0])
 
 #To use pythag function, must import some Python modules first:
 import math
@@ -51,90 +103,160 @@ def pythag(a: Union[int, float], b: Union[int, float]) -> float:
     c = math.sqrt(a**2 + b**2)
     return c
 
+#Streaming FASTA readers: one record at a time, so memory use depends on the longest record, not on the size of the file
+def read_fasta(filename: str):
+    '''Generator: reads through a FASTA file and yields a list [header line, sequence] for each record. Multi-line sequences are joined into a single string.'''
+    #local variables
+    curr_header: str = ""
+    seq_lines_list: list = []   #holds the sequence lines of the current record, joined once the record ends (adding them to a string one at a time is quadratic)
+
+    with open(filename, "r") as input_fh:
+        for line in input_fh:
+            line = line.strip()
+            if line.startswith(">"):    #if header line is being read, the previous record is finished
+                if curr_header != "":
+                    yield [curr_header, "".join(seq_lines_list)]
+                curr_header = line
+                seq_lines_list = []
+            else:
+                seq_lines_list.append(line)
+        if curr_header != "":
+            yield [curr_header, "".join(seq_lines_list)]
+
+def index_fasta(filename: str):
+    '''Generator: reads through a FASTA file without keeping any sequences and yields a list [header line, start offset, end offset, sequence length] for each record.
+    Offsets are byte offsets of the start of the record's header line and of the end of its last line, for read_fasta_record.'''
+    #local variables
+    curr_header: str = ""
+    record_start: int = 0
+    seq_len: int = 0
+    offset: int = 0     #byte offset of the start of the current line
+
+    with open(filename, "rb") as input_fh:
+        for line in input_fh:
+            if line.startswith(b">"):
+                if curr_header != "":
+                    yield [curr_header, record_start, offset, seq_len]
+                curr_header = line.strip().decode()
+                record_start = offset
+                seq_len = 0
+            else:
+                seq_len += len(line.strip())
+            offset += len(line)
+        if curr_header != "":
+            yield [curr_header, record_start, offset, seq_len]
+
+def read_fasta_record(input_fh, record_start: int, record_end: int) -> list:
+    '''Takes a FASTA file opened in binary mode and the offsets of one of its records (see index_fasta). Returns a list [header line, sequence] for that record.'''
+    #local variables
+    lines_list: list = []
+
+    input_fh.seek(record_start)
+    lines_list = input_fh.read(record_end - record_start).split(b"\n")
+    return [lines_list[0].strip().decode(), b"".join([line.strip() for line in lines_list[1:]]).decode()]
+
 #Protein FASTA filter (must import re first):
 import re
 def filter_longest_recs(filename: str):
-    '''Reads through a fasta file of proteins, extracts the longest protein record for each gene, and outputs these records into another fasta file.'''
+    '''Reads through a fasta file of proteins, extracts the longest protein record for each gene, and outputs these records into another fasta file.
+    The first pass only keeps the length and file offsets of the longest record of each gene; a second pass reads just those records back to write them, so memory use doesn't depend on the size of the file.'''
     #local variables
     output_fname: str = "filtered_" + filename
     prot_stable_ID: str = ""    #protein-stable ID
     gene_stable_ID: str = ""
     gene_name: str = ""
-    curr_seq: str = ""      #holds current sequence line being read
-    gene_dict1: dict = {}   #key:value -> geneID:new longest protein sequence
-    gene_dict2: dict = {}   #key:value -> geneID:[protein ID, gene_name]
+    longest_recs_dict: dict = {}   #key:value -> geneID:[length of longest protein sequence, start offset, end offset, protein ID, gene_name] (offsets -1 until a record with a sequence is found)
     output_header: str = ""
     output_seq: str = ""
 
-    with open(filename, "r") as input_fh, open(output_fname, "w") as output_fh:
-        for line in input_fh:
-            line = line.strip()
-            if line.startswith(">"):    #if header line is being read
-                curr_seq = ""           #for each header line read, reset the curr_seq back to "" for the next seq read
-
-                prot_stable_ID = re.search("(^>[a-zA-Z]+[Pp][0-9]+)([.][0-9]+)", line).group(1)
-                gene_stable_ID = re.search("(gene:)([a-zA-Z]+[Gg][0-9]+)([.][0-9]+)", line).group(2)
-                
-                search_res = re.search("(gene_symbol:)([a-zA-Z0-9_.:-]+)", line)
-                if search_res != None:
-                    gene_name = search_res.group(2)
-                else:
-                    gene_name = ""
-                
-                if gene_stable_ID not in gene_dict1:
-                    gene_dict1[gene_stable_ID] = ""
-                    gene_dict2[gene_stable_ID] = ["",""]
-            else:
-                curr_seq += line
-                #if length of protein seq that was just read > length of protein sequence previously read (that also belonged to same gene_ID from the most recently-read header line)
-                #If protein seq spans multiple lines, this code still works. 
-                # The curr_seq string just grows with each seq line read, and the protein-stable ID, gene name, and gene ID have not changed since the most recent header line was read, so it's ok to keep updating the dictionaries w/these values .
-                if len(curr_seq) > len(gene_dict1[gene_stable_ID]):
-                    gene_dict1[gene_stable_ID] = curr_seq
-                    gene_dict2[gene_stable_ID] = [prot_stable_ID, gene_name]
+    #first pass: find the longest protein record of each gene
+    for header, record_start, record_end, seq_len in index_fasta(filename):
+        prot_stable_ID = re.search("(^>[a-zA-Z]+[Pp][0-9]+)([.][0-9]+)", header).group(1)
+        gene_stable_ID = re.search("(gene:)([a-zA-Z]+[Gg][0-9]+)([.][0-9]+)", header).group(2)
         
-        #write filtered fasta records to output file
-        for genID in gene_dict2:
-            output_header = gene_dict2[genID][0] + " " + genID + " " + gene_dict2[genID][1]
-            output_seq = gene_dict1[genID] 
+        search_res = re.search("(gene_symbol:)([a-zA-Z0-9_.:-]+)", header)
+        if search_res != None:
+            gene_name = search_res.group(2)
+        else:
+            gene_name = ""
+        
+        if gene_stable_ID not in longest_recs_dict:
+            longest_recs_dict[gene_stable_ID] = [0, -1, -1, "", ""]
+        #if length of protein seq that was just read > length of protein sequence previously read for the same gene_ID, it becomes the gene's longest record
+        if seq_len > longest_recs_dict[gene_stable_ID][0]:
+            longest_recs_dict[gene_stable_ID] = [seq_len, record_start, record_end, prot_stable_ID, gene_name]
+
+    #second pass: read each gene's longest record back and write the filtered fasta records to output file
+    with open(filename, "rb") as input_fh, open(output_fname, "w") as output_fh:
+        for genID in longest_recs_dict:
+            output_header = longest_recs_dict[genID][3] + " " + genID + " " + longest_recs_dict[genID][4]
+            output_seq = ""
+            if longest_recs_dict[genID][1] >= 0:
+                output_seq = read_fasta_record(input_fh, longest_recs_dict[genID][1], longest_recs_dict[genID][2])[1]
             output_fh.write(output_header + "\n" + output_seq + "\n")
 
 # convert FASTA files with multiple sequence lines per record into FASTA files with each record's sequence on just 1 line
-#### Note: This function has not yet been tested. It needs to be tested/verified before you use it for the first time!
 def oneline_fasta(filename: str):
-    '''Reads through a FASTA file and concatenates each multi-line sequence into a single sequence line for each record.'''
+    '''Reads through a FASTA file and concatenates each multi-line sequence into a single sequence line for each record. Records are written out as they are read, so memory use doesn't depend on the size of the file.'''
     #local variables
     output_fname: str = "oneline_" + filename
-    curr_header: str = ""
-    curr_seq: str = ""      #holds current sequence line being read
-    record_num: int = 0
-    header_lines_list: list = []
-    seq_lines_list: list = []
 
-    with open(filename, "r") as input_fh, open(output_fname, "w") as output_fh:
-        for line in input_fh:
-            line = line.strip()
-            
-            if line.startswith(">"):    #if header line is being read
-                record_num += 1
-                curr_seq = ""           #for each header line read, reset the curr_seq back to "" for the next seq read
-                curr_header = line
-                header_lines_list.append(curr_header)
-            else:
-                curr_seq += line
+    with open(output_fname, "w") as output_fh:
+        for header, seq in read_fasta(filename):
+            #write FASTA header and concatenated sequence to output file
+            output_fh.write(header + "\n" + seq + "\n")
+
+
+#Gzipped FASTQ seek indexes (must import gzip, json, os first, and install indexed_gzip to use the indexes):
+#reads the sidecar files that Assignment-the-third/demux_gzindex.py builds for file.fq.gz (file.fq.gz.gzidx: zlib window checkpoints, file.fq.gz.gzidx.json: uncompressed byte offset of every records_per_point-th record),
+#so a script can start reading a big FASTQ file at any record instead of decompressing it from the beginning. Keep these in step with the copies in demux_gzindex.py, which writes the files.
+import gzip
+import json
+import os
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
 
-            if curr_seq != "" and len(seq_lines_list) == record_num - 1:
-                seq_lines_list.append(curr_seq)
-            elif curr_seq != "" and len(seq_lines_list) == record_num:
-                seq_lines_list[record_num - 1] = curr_seq    
+def load_seek_index(gz_filename: str) -> dict:
+    '''Returns the record offsets dictionary (keys: "records_per_point", "record_offsets", "num_records", "gz_size") of a gzipped file's seek index, or None if the file has no seek index,
+    if the index is out of date (the file changed since it was indexed), or if the indexed_gzip package isn't installed.'''
+    #local variables
+    offsets_filename: str = gz_filename + ".gzidx.json"
+    offsets_dict: dict = {}
+
+    if indexed_gzip is None or not os.path.exists(gz_filename + ".gzidx") or not os.path.exists(offsets_filename):
+        return None
+    with open(offsets_filename, "r") as offsets_fh:
+        offsets_dict = json.load(offsets_fh)
+    if offsets_dict["gz_size"] != os.path.getsize(gz_filename) or os.path.getmtime(offsets_filename) < os.path.getmtime(gz_filename):
+        return None
+    return offsets_dict
 
-        #write FASTA headers and concatenated sequences to output file
-        for i in range(len(header_lines_list)):
-            output_fh.write(header_lines_list[i] + "\n" + seq_lines_list[i] + "\n")
+def open_at_record(gz_filename: str, record_num: int) -> list:
+    '''Opens a gzipped FASTQ file for binary reading, starting as close to record record_num (counting from 0) as its seek index allows.
+    Returns a list [file object, number of the record the file object starts at]; the caller still has to skip the records between that one and record_num.
+    Files without a (current) seek index are opened at the beginning, i.e. at record 0.'''
+    #local variables
+    offsets_dict: dict = load_seek_index(gz_filename)
+    point_num: int = 0      #index in record_offsets of the last recorded record at or before record_num
+    gz_fh = None
 
+    if record_num <= 0 or offsets_dict is None:
+        return [gzip.open(gz_filename, "rb"), 0]
+    point_num = min(record_num // offsets_dict["records_per_point"], len(offsets_dict["record_offsets"]) - 1)
+    gz_fh = indexed_gzip.IndexedGzipFile(gz_filename, index_file=gz_filename + ".gzidx")
+    gz_fh.seek(offsets_dict["record_offsets"][point_num])
+    return [gz_fh, point_num * offsets_dict["records_per_point"]]
 
 
 if __name__ == "__main__":
-    print("final_Bioinfo.py is being run directly.")
-else:
-    print("final_Bioinfo.py has been imported for module use.")
\ No newline at end of file
+    #batch functions must give the same results as the scalar ones, including for empty sequences at the start, middle, and end of a list
+    assert gc_content_batch(["GC", ""])[0] == 1.0
+    assert qual_score_batch(["II", ""])[0] == 40.0
+    assert np.isnan(qual_score_batch(["II", ""])[1])
+    assert list(sum_per_seq(np.array([1, 2, 3, 4, 5]), np.array([0, 0, 2, 2, 5, 5]), np.array([0, 2, 0, 3, 0, 0]))) == [0, 3, 0, 12, 0, 0]
+    assert list(gc_content_batch(["", "GCAT", "", "GGA", ""])[[1, 3]]) == [0.5, 2 / 3]
+    assert list(validate_DNA_seq_batch(["ACGT", "", "ACNT", ""])) == [True, True, False, True]
+    assert list(qual_score_batch(["#I", "", "II"])[[0, 2]]) == [21.0, 40.0]
+    print("final_Bioinfo.py is being run directly, all checks passed.")
\ No newline at end of file
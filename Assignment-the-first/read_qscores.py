@@ -1,65 +1,204 @@
 #!/bin/python
 import argparse
-import gzip     #needed to read g-zipped files
-import matplotlib.pyplot as plt
-import Bioinfo
+import json     #needed to write/read the qscore histogram stats files
+import os       #needed to get the base name of each input file
+import sys      #needed to check for the report stage (read_qscores.py report ...)
+import concurrent.futures   #needed to process several input files at the same time
+import numpy as np  #needed to count qscores for a whole batch of reads at once
+import Bioinfo      #seek indexes, to start reading an input file at a given record (--record-range)
+
+NUM_QSCORES: int = 94   #phred+33 characters "!" (0) through "~" (93)
 
 def get_args():
     '''Defines/sets possible command line arguments for script'''
     parser = argparse.ArgumentParser("A program to process FASTQ data, get average quality score for each read position, and plot distribution")
-    parser.add_argument("-f", nargs="+", help="specifies input FASTQ filename(s)", type=str, required=True)
-    parser.add_argument("-o", help="specifies output file prefix", type=str, required=True)
+    parser.add_argument("-f", nargs="+", help="specifies input FASTQ filename(s). All files are processed at the same time.", type=str, required=True)
+    parser.add_argument("-o", help="specifies output file prefix. If more than one input file is given, the input file's name is added to the prefix for each file's outputs.", type=str, required=True)
+    parser.add_argument("-p", help="specifies number of input files processed at the same time (default: all of them)", type=int, default=0)
+    parser.add_argument("--no-report", help="only save each input file's qscore histogram to stats_<prefix>.json, without writing the means TSV and plot from it, so matplotlib is never imported. The reports can be written later with: read_qscores.py report stats_<prefix>.json [...]", action="store_true")
+    parser.add_argument("--record-range", nargs=2, help="specifies the first record (counting from 0) and the end record (not included, 0 for the end of the file) of the part of each input file to process. Files indexed with Assignment-the-third/demux_gzindex.py are opened right at the first record (default: all records)", type=int, default=[0, 0])
     return parser.parse_args()
 
-def parse_file(in_filename: str, out_file_prefix: str):
-    '''Open gzipped FASTQ file, put all qscores in file into arrays to track qscores for each nucleotide position.'''
+def add_qual_lines_to_histogram(qual_lines: list, qscore_histogram: np.ndarray) -> np.ndarray:
+    '''Takes a list of quality score lines (bytes, each ending in "\\n") and adds the qscore of every nucleotide position to a 2D histogram of counts (rows: nucleotide positions, cols: qscores 0-93).
+    Returns the histogram, which gets more rows if any line is longer than the histogram.'''
     # local variables
-    line_num: int = 0   #keep track of what line number of input file you're on
-    read_num: int = 0   #keep track of number of records/reads in input file
-    nuc_pos: int = 0    #keep track of nucleotide position
-    converted_phred: int = 0
-    sum_qscores_list: list = []     #keep track of the running total of qscores for each nucleotide position
-    mean_qscores_list: list = []    #holds the mean qscore for each nucleotide position
-    output_fname: str = "means_" + out_file_prefix + ".tsv"
-    plot_name: str = "plot_" + out_file_prefix + ".png"
-
-    with gzip.open(in_filename, 'rt') as input_file, open(output_fname, 'w') as output_file:
-        for line in input_file:
-            line_num += 1
-            line = line.strip()
-            if line_num % 4 == 0:   #grab the qscore line in filename
-                nuc_pos = 0
-                for char in line:
-                    converted_phred = Bioinfo.convert_phred(char)
-                    #if the sum_qscores_list doesn't yet have an element for each read position in the file:
-                    if len(sum_qscores_list) != len(line):
-                        sum_qscores_list.append(converted_phred)
-                    else:
-                        sum_qscores_list[nuc_pos] += converted_phred
-                    nuc_pos += 1
-                read_num += 1   #once whole qscore line is read, increment the read number    
-        mean_qscores_list = [sum_qscore / read_num for sum_qscore in sum_qscores_list]    #divide each element in sum_qscores_list by the number of reads in the file to get the avg qscore for each nucleotide position. Put each of these avg scores into a mean_qscore_list.    
-    
-        #write the mean qscore for each nucleotide position into an output file
-        output_file.write("Position\tMean\n")
-        for i in range(len(mean_qscores_list)):
-            output_file.write(str(i) + "\t" + str(mean_qscores_list[i]) + "\n")
-    
-    #plot mean qscore distribution
-    plt.bar(range(len(mean_qscores_list)), mean_qscores_list)
+    line_len: int = 0
+    qual_lines_by_len: dict = {}    #keys: line lengths, values: list of lines with that length
+    qscore_matrix = None    #2D array (rows: reads, cols: nucleotide positions) of qscores
+
+    #lines of different lengths can't go in the same matrix, so group them by length (normally there's only 1 group)
+    if len(set(map(len, qual_lines))) == 1:
+        qual_lines_by_len[len(qual_lines[0])] = qual_lines
+    else:
+        for line in qual_lines:
+            if len(line) not in qual_lines_by_len:
+                qual_lines_by_len[len(line)] = []
+            qual_lines_by_len[len(line)].append(line)
+
+    for line_len in qual_lines_by_len:
+        if line_len - 1 > qscore_histogram.shape[0]:
+            qscore_histogram = np.pad(qscore_histogram, ((0, line_len - 1 - qscore_histogram.shape[0]), (0, 0)))
+        #each row holds the line's "\n" as its last column, which gets dropped, so the lines never have to be stripped one at a time
+        qscore_matrix = np.frombuffer(b"".join(qual_lines_by_len[line_len]), dtype=np.uint8).reshape(-1, line_len)[:, :-1] - 33
+        #count each (position, qscore) combination: position * NUM_QSCORES + qscore is the index of that histogram cell in the flattened histogram
+        qscore_histogram[:line_len - 1] += np.bincount(
+            (np.arange(line_len - 1, dtype=np.int64) * NUM_QSCORES + qscore_matrix).ravel(),
+            minlength=(line_len - 1) * NUM_QSCORES
+            ).reshape(line_len - 1, NUM_QSCORES)
+    return qscore_histogram
+
+def get_qscore_histogram(in_filename: str, record_range: list = None) -> np.ndarray:
+    '''Open gzipped FASTQ file and count the qscores at each nucleotide position in batches of reads. Returns a 2D histogram of counts (rows: nucleotide positions, cols: qscores 0-93). Memory use doesn't depend on the size of the file.
+    If record_range is a list [first record, end record], only records first record (counting from 0) up to but not including end record (0: the end of the file) are counted; files with a seek index (see Bioinfo.open_at_record) are opened right at the first record.'''
+    # local variables
+    line_num: int = 0   #keep track of what line number of input file you're on (line number of first line in the current batch)
+    first_line: int = 0 #line number of the first line to count
+    end_line: int = -1  #line number after the last line to count, or -1 to count to the end of the file
+    lines_list: list = []
+    qual_lines: list = []
+    qscore_histogram: np.ndarray = np.zeros((0, NUM_QSCORES), dtype=np.int64)
+
+    if record_range is None:
+        record_range = [0, 0]
+    first_line = 4 * record_range[0]
+    if record_range[1] > 0:
+        end_line = 4 * record_range[1]
+
+    input_file, seek_record = Bioinfo.open_at_record(in_filename, record_range[0])
+    line_num = 4 * seek_record
+    with input_file:
+        while line_num != end_line:
+            lines_list = input_file.readlines(4194304)  #read ~4 MiB of whole lines at a time
+            if len(lines_list) == 0:
+                break
+            #drop lines before the first record / after the end record
+            if line_num < first_line:
+                if line_num + len(lines_list) <= first_line:
+                    line_num += len(lines_list)
+                    continue
+                lines_list = lines_list[first_line - line_num:]
+                line_num = first_line
+            if end_line >= 0 and line_num + len(lines_list) > end_line:
+                lines_list = lines_list[:end_line - line_num]
+            #grab the qscore lines (every 4th line of file, starting at line 3 counting from 0)
+            qual_lines = lines_list[(3 - line_num) % 4::4]
+            line_num += len(lines_list)
+            if len(qual_lines) == 0:
+                continue
+            if not qual_lines[-1].endswith(b"\n"):  #last line of file had no "\n"
+                qual_lines[-1] += b"\n"
+            qscore_histogram = add_qual_lines_to_histogram(qual_lines, qscore_histogram)
+    return qscore_histogram
+
+def get_position_stats(qscore_histogram: np.ndarray) -> dict:
+    '''Takes a qscore histogram (see get_qscore_histogram) and returns a dictionary of 1D arrays with a value for each nucleotide position:
+    "count" (number of reads covering the position), "mean", "median", "lower_quartile", "upper_quartile" qscores. Quantiles are the lowest qscore at which that fraction of reads is reached.'''
+    # local variables
+    counts: np.ndarray = qscore_histogram.sum(axis=1)
+    cumulative_counts: np.ndarray = np.cumsum(qscore_histogram, axis=1)
+    position_stats_dict: dict = {"count": counts}
+
+    position_stats_dict["mean"] = (qscore_histogram * np.arange(NUM_QSCORES)).sum(axis=1) / np.maximum(counts, 1)
+    for stat_name, fraction in [("lower_quartile", 0.25), ("median", 0.5), ("upper_quartile", 0.75)]:
+        #first qscore whose cumulative count reaches the fraction of reads at that position
+        position_stats_dict[stat_name] = (cumulative_counts < (fraction * counts)[:, np.newaxis]).sum(axis=1)
+    return position_stats_dict
+
+def write_stats_file(stats_filename: str, out_file_prefix: str, qscore_histogram: np.ndarray):
+    '''Writes a qscore histogram (see get_qscore_histogram) and the output file prefix of its reports to a JSON stats file, so the reports can be written from it by write_report, in the same run or later.'''
+    with open(stats_filename, "w") as stats_fh:
+        json.dump({"out_file_prefix": out_file_prefix, "qscore_histogram": qscore_histogram.tolist()}, stats_fh)
+
+def plot_mean_qscores(plot_name: str, means: np.ndarray):
+    '''Plots the mean qscore of each nucleotide position to plot_name.'''
+    #imported here instead of at the top, so runs that don't write reports never load matplotlib
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    plt.bar(range(len(means)), means)
     plt.title("Mean Quality Score for all Nucleotide Positions")
     plt.xlabel("Nucleotide Position")
     plt.ylabel("Mean Quality Score")
     plt.savefig(plot_name)
+    plt.close()
+
+def write_report(stats_filename: str, plot: bool = True):
+    '''Reads a stats file (see write_stats_file), writes the mean, median, and quartile qscores for each nucleotide position to means_<prefix>.tsv, and (if plot is True) plots the mean qscores to plot_<prefix>.png. Reports are written next to the stats file.'''
+    # local variables
+    stats_dict: dict = {}
+    position_stats_dict: dict = {}
+    output_fname: str = ""
+    plot_name: str = ""
+
+    with open(stats_filename, "r") as stats_fh:
+        stats_dict = json.load(stats_fh)
+    output_fname = os.path.join(os.path.dirname(stats_filename), "means_" + stats_dict["out_file_prefix"] + ".tsv")
+    plot_name = os.path.join(os.path.dirname(stats_filename), "plot_" + stats_dict["out_file_prefix"] + ".png")
+    position_stats_dict = get_position_stats(np.array(stats_dict["qscore_histogram"], dtype=np.int64).reshape(-1, NUM_QSCORES))
+
+    #write the mean qscore (and median/quartiles) for each nucleotide position into an output file
+    with open(output_fname, 'w') as output_file:
+        output_file.write("Position\tMean\tMedian\tLower_Quartile\tUpper_Quartile\n")
+        for i in range(len(position_stats_dict["mean"])):
+            output_file.write(
+                str(i) + "\t" + str(position_stats_dict["mean"][i]) + "\t" + str(position_stats_dict["median"][i]) + "\t"
+                + str(position_stats_dict["lower_quartile"][i]) + "\t" + str(position_stats_dict["upper_quartile"][i]) + "\n"
+                )
+
+    #plot mean qscore distribution
+    if plot:
+        plot_mean_qscores(plot_name, position_stats_dict["mean"])
+
+def parse_file(in_filename: str, out_file_prefix: str, qscore_histogram: np.ndarray = None, report: bool = True):
+    '''Get the qscore histogram of a gzipped FASTQ file (unless it's already given) and save it to stats_<prefix>.json (see write_stats_file). 
+    If report is True, the means TSV and plot are then written from it (see write_report); if that fails (e.g. a broken matplotlib install), the error is printed and the stats file is kept, so the reports can be written again later.'''
+    # local variables
+    stats_filename: str = "stats_" + out_file_prefix + ".json"
+
+    if qscore_histogram is None:
+        qscore_histogram = get_qscore_histogram(in_filename)
+    write_stats_file(stats_filename, out_file_prefix, qscore_histogram)
+
+    if not report:
+        return
+    try:
+        write_report(stats_filename)
+    except Exception as error:
+        print("Couldn't write the reports of " + stats_filename + " (" + repr(error) + "), the qscore histogram is saved in it: run read_qscores.py report " + stats_filename + " to try again", file=sys.stderr)
+
+def get_report_args():
+    '''Defines/sets possible command line arguments for the report stage (read_qscores.py report ...)'''
+    parser = argparse.ArgumentParser("read_qscores.py report", description="Writes the means TSV and plot of each stats file written by read_qscores.py (e.g. after --no-report), without reading any FASTQ files. Reports are written next to each stats file.")
+    parser.add_argument("stats_files", nargs="+", help="specifies stats file(s) (stats_<prefix>.json)", type=str)
+    parser.add_argument("--no-plot", help="only write the means TSV files, not the plots", action="store_true")
+    return parser.parse_args(sys.argv[2:])
+
+def report_main():
+    '''Main function of the report stage, writes the reports of each given stats file'''
+    # local variables
+    args = get_report_args()
+
+    for stats_filename in args.stats_files:
+        write_report(stats_filename, not args.no_plot)
 
 def main():
     '''Main function, drives the order of execution for script'''
     # local variables
     args = get_args()
     output_file_prefix = args.o
+    num_processes: int = args.p if args.p > 0 else len(args.f)
 
-    for input_filename in args.f:
-        parse_file(input_filename, output_file_prefix)
+    #count qscores of all input files at the same time, each in its own process
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for input_filename, qscore_histogram in zip(args.f, executor.map(get_qscore_histogram, args.f, [args.record_range] * len(args.f))):
+            if len(args.f) > 1:
+                parse_file(input_filename, output_file_prefix + "_" + os.path.basename(input_filename), qscore_histogram, not args.no_report)
+            else:
+                parse_file(input_filename, output_file_prefix, qscore_histogram, not args.no_report)
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "report":
+        report_main()
+    else:
+        main()
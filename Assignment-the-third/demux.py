@@ -1,16 +1,78 @@
 #!/bin/python
 import argparse
-import gzip     #needed to open/read gzipped files and write to gzipped files
-import matplotlib.pyplot as plt
+import json     #needed to write/read checkpoint files
+import os       #needed to get/truncate output file sizes and replace checkpoint files atomically
+import sys      #needed to write progress reports to stderr
+import signal   #needed to turn SIGTERM (kill, scancel) into a normal exit, so a killed run still cleans up
+import time     #needed to time each stage of the demultiplexing loop
+import cProfile     #needed for --profile
+import pstats       #needed to write a readable summary of --profile stats
+import multiprocessing  #needed to classify batches of records on several CPUs at once (--workers)
+import itertools     #needed to enumerate mismatch positions/bases when building the index table
+import concurrent.futures   #needed for the thread pool that compresses output blocks (--compress)
+from collections import deque
+import numpy as np  #needed to check index qscores for a whole batch of records at once
+import demux_io     #threaded decompression of the input files, BGZF compression of the output files
+import demux_metrics    #per-stage timers/counters and progress reports
+import demux_gzindex    #seek indexes of the input files, to sample from across the whole file (--sample)
+
+#globals set once in each worker process by init_worker(), so the reference indexes don't have to be re-sent with every batch
+_worker_index_table: dict = {}
+_worker_quality_filter: dict = {}
+_worker_output_files_dict: dict = {}    #output files the workers append their batches to, empty if the main process writes the output (see demultiplex_batches)
+_worker_turn = None                     #multiprocessing.Condition the workers wait on for their turn to write
+_worker_next_batch = None               #multiprocessing.Value: number of the next batch to be written
+_worker_parent_pid: int = 0             #process ID of the main process, to check it's still running before writing
+
+#report files rendered from a stats file (see write_report). keys: report types, values: [bucket report TSV, bucket plot PNG, index pair matrix prefix]
+REPORT_FILENAMES_DICT: dict = {
+    "final": ["demux_final_report.tsv", "demux_final_plot.png", "demux_index_pair_matrix"], 
+    "sample": ["demux_sample_report.tsv", "demux_sample_plot.png", "demux_sample_index_pair_matrix"]
+    }
 
 def get_args():
     '''Defines/sets possible command line arguments for script'''
     parser = argparse.ArgumentParser("A program to demultiplex FASTQ data")
-    parser.add_argument("-r", nargs="+", help="Specifies input FASTQ read file name(s). Note: Only the first 2 files specified will be parsed.", type=str, required=True)
-    parser.add_argument("-i", nargs="+", help="Specifies input FASTQ index file name(s). Note: Only the first 2 files specified will be parsed.", type=str, required=True)
+    parser.add_argument("-r", nargs="+", help="Specifies input FASTQ read file name(s). Note: Only the first 2 files specified will be parsed. Required unless --manifest is given.", type=str)
+    parser.add_argument("-i", nargs="+", help="Specifies input FASTQ index file name(s). Note: Only the first 2 files specified will be parsed. Required unless --manifest is given.", type=str)
+    parser.add_argument("--manifest", help="Specifies a tab-separated file of lanes to demultiplex in one run instead of -r/-i: a header line, then 1 line per lane with columns lane name, read1 file, read2 file, index1 file, index2 file. Each lane's outputs and reports go in a directory named after the lane, and demux_batch_summary.tsv covers all lanes.", type=str, default="")
+    parser.add_argument("--lanes-at-once", help="Specifies number of lanes from --manifest demultiplexed at the same time; the --workers CPU budget is split between them (default=0: as many as the budget allows, 1 CPU per lane at least).", type=int, default=0)
     parser.add_argument("-t", help="Specifies text file containing the known reference indexes that the indexes in the FASTQ index files will be compared to.", type=str, required=True)
     parser.add_argument("-q", help="Specifies quality score mimimum value to use as cutoff for index file qscores (default=30).", type=int, default=30)
-    return parser.parse_args()
+    parser.add_argument("--qscore-policy", help="Specifies how the -q cutoff is applied to each index read: 'min' fails reads with any qscore below the cutoff, 'mean' fails reads whose mean qscore is below the cutoff, 'maxlow' fails reads with more than --max-low-bases qscores below the cutoff (default=min).", choices=["min", "mean", "maxlow"], default="min")
+    parser.add_argument("--max-low-bases", help="Specifies number of qscores below the cutoff allowed per index read with --qscore-policy maxlow (default=0).", type=int, default=0)
+    parser.add_argument("-m", "--max-mismatches", help="Specifies maximum number of mismatches (substitutions or Ns) allowed between an index read and a reference index for the read to still be assigned to that index (default=0). Index reads within this distance of 2 or more reference indexes are not corrected.", type=int, default=0)
+    parser.add_argument("-w", "--workers", help="Specifies number of worker processes used to classify records and, unless --compress is used, write them to the output files (default=1, no worker processes). Output is identical for any number of workers. Decompression stays in the main process unless --decompressor is used, which limits how far more workers can speed a run up (see demux_benchmark.py run -w 1 2 4 8). With --manifest, this is the CPU budget shared by all lanes running at the same time.", type=int, default=1)
+    parser.add_argument("--decompressor", help="Specifies an external command used to decompress the input files instead of Python's zlib, e.g. \"pigz -dc\" (the input filename is added to the end of the command). Each input file is still read on its own thread (default: none).", type=str, default="")
+    parser.add_argument("--prefetch-chunks", help="Specifies number of 1 MiB decompressed chunks buffered ahead of the demultiplexer for each input file (default=8).", type=int, default=8)
+    parser.add_argument("-z", "--compress", help="Write output FASTQ files as BGZF-compressed files (.gz, readable by gzip/zcat and randomly accessible by htslib tools) instead of uncompressed files.", action="store_true")
+    parser.add_argument("--compress-level", help="Specifies compression level (1-9) used with --compress (default=6).", type=int, default=6)
+    parser.add_argument("--compress-threads", help="Specifies number of threads shared by all output files to compress blocks with --compress (default=4).", type=int, default=4)
+    parser.add_argument("--buffer-size-mb", help="Specifies maximum total size (in MiB) of output data buffered in memory across all output files before the largest buffers are written out (default=64). With --compress this also covers data waiting to be compressed, and buffered data is compressed when it's written out, including at every checkpoint.", type=int, default=64)
+    parser.add_argument("--max-open-files", help="Specifies maximum number of output files kept open at once; if there are more output files, they are closed/reopened in append mode as needed (default=0, based on ulimit -n).", type=int, default=0)
+    parser.add_argument("--fifo", help="Create the output FASTQ files as named pipes (FIFOs) and stream reads into them as they're demultiplexed, so the next tool can read them without the reads being written to disk. Every output file needs a reader, or the run stalls. The pipes are removed at the end, or when the run fails or is stopped (Ctrl-C, kill). Can't be used with --compress or --resume.", action="store_true")
+    parser.add_argument("--stdout-bucket", help="Write only the read-pairs of this bucket (an index name such as B1, a reference index sequence, 'swapped', or 'unknown_lowQ') to stdout, as interleaved paired FASTQ, instead of writing output FASTQ files. Can't be used with --manifest, --fifo, --compress or --resume (default: none).", type=str, default="")
+    parser.add_argument("--sample", help="Estimate the bucket distribution from a sample of this many read-pairs instead of demultiplexing everything: only the index files are read, no FASTQ files are written, and the counts go to demux_sample_report.tsv/demux_sample_plot.png with 95%% confidence intervals (default=0, full run).", type=int, default=0)
+    parser.add_argument("--sample-method", help="Specifies how --sample picks read-pairs: 'head' takes the first ones, 'stride' takes evenly spaced slices from across the whole file using the index files' seek indexes (see demux_gzindex.py; without them it falls back to 'head'), 'reservoir' reads the whole index files and keeps a uniform random sample (default=stride).", choices=["head", "stride", "reservoir"], default="stride")
+    parser.add_argument("--sample-seed", help="Specifies random seed for --sample-method reservoir (default=1).", type=int, default=1)
+    parser.add_argument("--checkpoint-every", help="Specifies number of read-pairs between checkpoints written to demux_checkpoint.json, which --resume can continue from if the run gets killed (default=10000000, 0 to turn off).", type=int, default=10000000)
+    parser.add_argument("--resume", help="Continue a killed run from its last checkpoint (demux_checkpoint.json): output files are truncated back to the checkpoint and demultiplexing continues from the next record. All other arguments must be the same as in the original run.", action="store_true")
+    parser.add_argument("--record-range", nargs=2, help="Specifies the first record (counting from 0) and the end record (not included, 0 for the end of the files) of the part of the input files to demultiplex, e.g. to split a lane across several jobs. Input files indexed with demux_gzindex.py are opened right at the first record; other files are read from the beginning (default: all records).", type=int, default=[0, 0])
+    parser.add_argument("--no-report", help="Only save the bucket counters and index pair matrix to demux_stats.json (demux_sample_stats.json with --sample) at the end of the run, without rendering the TSV/PNG reports from them, so matplotlib is never imported. The reports can be rendered later, for any number of lanes, with: demux.py report demux_stats.json [...].", action="store_true")
+    parser.add_argument("--metrics-file", help="Specifies file that JSON-lines progress reports (records/sec, bytes/sec, seconds spent in each stage) get written to (default: stderr). With --manifest, each lane gets its own file: a relative path is relative to the lane's directory, and an absolute path gets '_<lane name>' added before its extension.", type=str, default="")
+    parser.add_argument("--metrics-interval", help="Specifies number of seconds between progress reports (default=60).", type=float, default=60)
+    parser.add_argument("--profile", help="Run under cProfile and write the stats to demux_profile.prof (and a readable summary to demux_profile.txt). With --workers, only the main process (reading/writing) is profiled.", action="store_true")
+    parser.add_argument("--batch-size", help="Specifies number of read-pairs read from the inputs and handed to a worker at a time (default=10000).", type=int, default=10000)
+    args = parser.parse_args()
+    if args.manifest == "" and (args.r is None or args.i is None):
+        parser.error("-r and -i are required unless --manifest is given")
+    if (args.fifo or args.stdout_bucket != "") and (args.compress or args.resume):
+        parser.error("--fifo and --stdout-bucket can't be used with --compress or --resume")
+    if args.sample > 0 and (args.fifo or args.stdout_bucket != "" or args.resume):
+        parser.error("--sample doesn't write FASTQ output, so it can't be used with --fifo, --stdout-bucket or --resume")
+    if args.stdout_bucket != "" and (args.fifo or args.manifest != ""):
+        parser.error("--stdout-bucket can't be used with --fifo or --manifest")
+    return args
 
 def convert_phred(letter: str) -> int:
     '''Converts a single character into a phred score'''
@@ -36,7 +98,8 @@ def rev_comp(seq: str) -> str:
     return rev_comp_seq
 
 def get_ref_indexes(ref_indexes_file: str) -> dict:
-    '''Takes a text file of known reference indexes and puts the index names (A1, A2, B1, C1, etc) and index sequences in a dictionary. Returns the dictionary.'''
+    '''Takes a text file of known reference indexes and puts the index names (A1, A2, B1, C1, etc) and index sequences in a dictionary. Returns the dictionary.
+    The order of the dictionary (the order of the file) gives each reference index its integer ID: 0 for the first index, 1 for the second, etc (see get_index_table).'''
     # local variables
     index_name: str = ""
     index_seq: str = ""
@@ -52,8 +115,91 @@ def get_ref_indexes(ref_indexes_file: str) -> dict:
                 ref_indexes_dict[index_seq] = index_name
     return ref_indexes_dict
 
-def get_output_files_dict(read1_file: str, read2_file: str, ref_indexes_dict: dict) -> dict:
-    '''Create a dictionary to keep track of 52 output filenames: 26 FASTQ files for each of the two input biological read FASTQ files (total of 52 FASTQ files). For each input read file, there are 24 output FASTQ files, with each file containing all the correctly-indexed reads for a specific index-pair (correct index sequences are listed in indexes.txt file on Talapas). In addition, for each input read file, there is also a 25th output FASTQ file for all the reads with hopped indexes, and a 26th output FASTQ file for all the reads with indexes that don't match the indexes in the indexes.txt file and/or indexes with low-quality scores.'''
+def get_index_neighbors(seq: str, max_mismatches: int) -> dict:
+    '''Takes a sequence and returns a dictionary of every sequence within max_mismatches substitutions (to A, C, G, T, or N) of it. keys: sequences, values: number of mismatches from the input sequence.'''
+    # local variables
+    neighbors_dict: dict = {seq: 0}    #keys: neighbor sequences, values: number of mismatches
+    neighbor_list: list = []
+
+    for num_mismatches in range(1, max_mismatches + 1):
+        for positions in itertools.combinations(range(len(seq)), num_mismatches):
+            #for each chosen position, substitute every base other than the one already there
+            for bases in itertools.product(*["ACGTN".replace(seq[pos], "") for pos in positions]):
+                neighbor_list = list(seq)
+                for pos, base in zip(positions, bases):
+                    neighbor_list[pos] = base
+                if "".join(neighbor_list) not in neighbors_dict:
+                    neighbors_dict["".join(neighbor_list)] = num_mismatches
+    return neighbors_dict
+
+def get_index_table(ref_indexes_dict: dict, max_mismatches: int = 0) -> dict:
+    '''Takes the reference indexes dictionary (see get_ref_indexes) and builds the lookup table used to classify every read-pair, so no reverse complements or membership checks have to be done per record.
+    Each reference index gets an integer ID (its position in ref_indexes_dict). Returns a dictionary with:
+        "index1_ids": keys: index1 read sequences (as bytes), values: ID of the reference index they match
+        "index2_ids": keys: index2 read sequences (as bytes), values: ID of the reference index whose reverse complement they match
+        "pair_buckets": 2D list, pair_buckets[index1 ID][index2 ID] holds the bucket key (reference index sequence, "swapped", or "unknown_lowQ") for that pair. ID len(ref_indexes_dict) stands for an unknown index.
+        "ref_index_seqs": list of reference index sequences, in ID order
+        "ref_index_names": list of reference index names, in ID order
+        "max_mismatches": max_mismatches
+    Sequences within max_mismatches of a reference index are also assigned to it, unless they are equally close to 2 or more reference indexes (those are left out, so they stay unknown).'''
+    # local variables
+    ref_index_seqs: list = list(ref_indexes_dict.keys())
+    unknown_id: int = len(ref_index_seqs)
+    index1_ids: dict = {}
+    index2_ids: dict = {}
+    pair_buckets: list = []
+
+    for ids_dict, ref_seqs in [(index1_ids, ref_index_seqs), (index2_ids, [rev_comp(ref_seq) for ref_seq in ref_index_seqs])]:
+        closest_dict: dict = {}     #keys: read sequences, values: list [number of mismatches to closest reference index, ID of closest reference index or unknown_id if there's a tie]
+        for ref_id, ref_seq in enumerate(ref_seqs):
+            for neighbor_seq, num_mismatches in get_index_neighbors(ref_seq, max_mismatches).items():
+                if neighbor_seq not in closest_dict or num_mismatches < closest_dict[neighbor_seq][0]:
+                    closest_dict[neighbor_seq] = [num_mismatches, ref_id]
+                elif num_mismatches == closest_dict[neighbor_seq][0]:
+                    closest_dict[neighbor_seq][1] = unknown_id   #collision: can't tell which reference index this read came from
+        for neighbor_seq in closest_dict:
+            if closest_dict[neighbor_seq][1] != unknown_id:
+                ids_dict[neighbor_seq.encode("ascii")] = closest_dict[neighbor_seq][1]   #bytes keys, since input files are read in binary mode (see get_record_blocks)
+
+    #fill in the bucket for every (index1 ID, index2 ID) pair, including the unknown ID
+    for index1_id in range(unknown_id + 1):
+        pair_buckets.append([])
+        for index2_id in range(unknown_id + 1):
+            if index1_id == unknown_id or index2_id == unknown_id:
+                pair_buckets[index1_id].append("unknown_lowQ")
+            elif index1_id == index2_id:
+                pair_buckets[index1_id].append(ref_index_seqs[index1_id])
+            else:
+                pair_buckets[index1_id].append("swapped")
+
+    return {"index1_ids": index1_ids, "index2_ids": index2_ids, "pair_buckets": pair_buckets, "ref_index_seqs": ref_index_seqs, "ref_index_names": list(ref_indexes_dict.values()), "max_mismatches": max_mismatches}
+
+def get_index_pair_matrix(index_table: dict, pair_codes: np.ndarray = None) -> np.ndarray:
+    '''Returns a 2D array of read-pair counts (rows: index1 IDs, cols: index2 IDs, see get_index_table; the last row/col is the unknown ID) for an index table. 
+    pair_codes holds index1 ID * (number of IDs) + index2 ID for each read-pair to count; if it's not given, the matrix is all zeros.'''
+    # local variables
+    num_ids: int = len(index_table["ref_index_seqs"]) + 1  #reference indexes + unknown
+
+    if pair_codes is None:
+        return np.zeros((num_ids, num_ids), dtype=np.int64)
+    return np.bincount(pair_codes, minlength=num_ids * num_ids).reshape(num_ids, num_ids)
+
+def get_index_pair_labels(index_table: dict) -> list:
+    '''Returns a list of the row/col labels of an index table's index pair matrix (see get_index_pair_matrix): "name_sequence" of each reference index, then "unknown".'''
+    return [ref_name + "_" + ref_seq for ref_name, ref_seq in zip(index_table["ref_index_names"], index_table["ref_index_seqs"])] + ["unknown"]
+
+def write_index_pair_matrix(index_pair_matrix: np.ndarray, labels_list: list, matrix_filename_prefix: str):
+    '''Writes an index pair matrix (see get_index_pair_matrix) to matrix_filename_prefix + ".tsv" (rows: index1, cols: index2, labeled with labels_list, see get_index_pair_labels) and to matrix_filename_prefix + ".npy" (the raw count array, for numpy.load).
+    The diagonal holds correctly matched read-pairs; every other reference index cell holds read-pairs that hopped from one index pair to another.'''
+    np.save(matrix_filename_prefix + ".npy", index_pair_matrix)
+    with open(matrix_filename_prefix + ".tsv", "w") as matrix_fh:
+        matrix_fh.write("Index1/Index2\t" + "\t".join(labels_list) + "\n")
+        for label, row in zip(labels_list, index_pair_matrix.tolist()):
+            matrix_fh.write(label + "\t" + "\t".join(map(str, row)) + "\n")
+
+def get_output_files_dict(read1_file: str, read2_file: str, ref_indexes_dict: dict, compress: bool = False) -> dict:
+    '''Create a dictionary to keep track of 52 output filenames: 26 FASTQ files for each of the two input biological read FASTQ files (total of 52 FASTQ files). For each input read file, there are 24 output FASTQ files, with each file containing all the correctly-indexed reads for a specific index-pair (correct index sequences are listed in indexes.txt file on Talapas). In addition, for each input read file, there is also a 25th output FASTQ file for all the reads with hopped indexes, and a 26th output FASTQ file for all the reads with indexes that don't match the indexes in the indexes.txt file and/or indexes with low-quality scores.
+    If compress is True, ".gz" is added to the end of each output filename.'''
     # local variables
     output_files_dict: dict = {}    #keys: reference index sequence, values: list [read1 output file for index, read2 output file for index]
     read1_outfile: str = ""
@@ -62,6 +208,9 @@ def get_output_files_dict(read1_file: str, read2_file: str, ref_indexes_dict: di
     #split the absolute filepaths stored in read1_file and read2_file based on "/", and extract only the name of the file itself (relative to current directory)
     read1_file = read1_file.split("/")[-1].strip(".gz")
     read2_file = read2_file.split("/")[-1].strip(".gz")
+    if compress:
+        read1_file += ".gz"
+        read2_file += ".gz"
 
     #create output filenames for each index, for each input read file (48 filenames)
     for ref_index_seq, ref_index_name in list(ref_indexes_dict.items()):
@@ -87,200 +236,939 @@ def get_output_files_dict(read1_file: str, read2_file: str, ref_indexes_dict: di
     
     return output_files_dict
 
-def get_record(input_filehandlers_list: list) -> list:
-    '''Read 4 lines (1 record) from each of the 4 input filehandlers in a given list, store lines in 2d list, and return the reference to the 2d list'''
+def get_bucket_key(bucket_name: str, ref_indexes_dict: dict) -> str:
+    '''Takes a bucket given by the user (a reference index name such as B1, a reference index sequence, "swapped", or "unknown_lowQ") and returns its bucket key (see classify_batch).
+    Raises a ValueError if it isn't any of those.'''
+    for ref_index_seq, ref_index_name in ref_indexes_dict.items():
+        if bucket_name == ref_index_name:
+            return ref_index_seq
+    if bucket_name in ref_indexes_dict or bucket_name in ["swapped", "unknown_lowQ"]:
+        return bucket_name
+    raise ValueError("Unknown bucket: " + bucket_name + " (expected a reference index name or sequence, 'swapped', or 'unknown_lowQ')")
+
+def get_read_name(header_line: bytes) -> bytes:
+    '''Returns the read name of a FASTQ header line: everything up to the first space, without an old-style "/1", "/2", etc. read number suffix.'''
     # local variables
-    row: int = 0
-    col: int = 0
-    line: str = ""
-    record_list: list = [["" for i in range(4)] for j in range(4)]     
-        #2D list of strings (4 rows, 4 cols) to temporarily hold a record from each of the 4 input files  
-        #record_list[0]: holds record for input biological read file 1
-        #record_list[1]: holds record for input biological read file 2
-        #record_list[2]: holds record for input index read file 1
-        #record_list[3]: holds record for input index read file 2
-        #for each record from an input file, 
-            #record_list[i][0]: holds header line
-            #record_list[i][1]: holds sequence line
-            #record_list[i][2]: holds "+" line
-            #record_list[i][3]: holds quality score line
-
-    row = 0
-    while row < 4:
-        #print(input_filehandlers_list[row]) 
-        col = 0
-        while col < 4:
-            line = input_filehandlers_list[row].readline()
-            line = line.strip("\n")
-            #print(line)
-            record_list[row][col] = line
-            col += 1
-        row += 1
-    #print(record_list)    
-    return record_list
-
-def parse_input_files(read1_file: str, read2_file: str, index1_file: str, index2_file: str, ref_indexes_dict: dict, output_files_dict: dict, qscore_cutoff: int):
-    '''Takes 2 FASTQ read files and 2 FASTQ index files and demultiplexes them based on indexes in a given reference index file and based on a given quality score cutoff.'''
+    read_name: bytes = header_line.split(b" ", 1)[0]
+
+    if read_name[-2:-1] == b"/":
+        read_name = read_name[:-2]
+    return read_name
+
+def get_raw_record_blocks(input_filehandlers_list: list, batch_size: int, chunk_size: int = 1048576, max_records: int = 0):
+    '''Generator: reads the input files (opened in binary mode) in large chunks and yields raw blocks of up to batch_size records from each file, without splitting them into lines.
+    Each raw block is a list of bytes (one per input file, in the same order as input_filehandlers_list) holding the same number of whole records from each file, every line ending in "\\n" (see split_record_block).
+    Newlines are only counted per chunk, and only the chunk a block ends in is searched for the block's last newline, so this is cheap enough for the main process to do while worker processes do the per-line work.
+    If max_records > 0, no more than max_records records are yielded (records before a record range are skipped by demux_io.PrefetchReader).
+    Raises a ValueError if the input files don't have the same number of records.'''
+    # local variables
+    pending_chunks_list: list = [[] for fh in input_filehandlers_list]  #holds chunks read from each input file that haven't been yielded yet
+    chunk_newlines_list: list = [[] for fh in input_filehandlers_list]  #number of "\\n"s in each of those chunks
+    is_eof_list: list = [False for fh in input_filehandlers_list]
+    chunk: bytes = b""
+    lines_left: int = 0     #lines of the block still to be taken from the current chunk
+    k: int = 0              #index of the chunk the block ends in
+    block_end: int = 0      #position just after the block's last line in that chunk
+    num_records: int = 0
+    records_left: int = max_records if max_records > 0 else -1     #records left to yield, or -1 for no limit
+    raw_block: list = []
+
+    while records_left != 0:
+        #top up each input file's pending chunks until there are enough lines for a full block
+        for i, fh in enumerate(input_filehandlers_list):
+            while sum(chunk_newlines_list[i]) < 4 * batch_size and not is_eof_list[i]:
+                chunk = fh.read(chunk_size)
+                if chunk == b"":
+                    is_eof_list[i] = True
+                    if len(pending_chunks_list[i]) > 0 and not pending_chunks_list[i][-1].endswith(b"\n"):     #last line of file had no "\\n"
+                        pending_chunks_list[i].append(b"\n")
+                        chunk_newlines_list[i].append(1)
+                    break
+                pending_chunks_list[i].append(chunk)
+                chunk_newlines_list[i].append(chunk.count(b"\n"))
+
+        num_records = min(batch_size, min([sum(chunk_newlines) // 4 for chunk_newlines in chunk_newlines_list]))
+        if records_left > 0:
+            num_records = min(num_records, records_left)
+            records_left -= num_records
+        if num_records == 0:
+            if any([len(pending_chunks) > 0 for pending_chunks in pending_chunks_list]):
+                raise ValueError("Input FASTQ files don't have the same number of records (or a file ends with an incomplete record)")
+            return
+
+        raw_block = []
+        for i in range(len(input_filehandlers_list)):
+            #find the chunk the block's last line ends in, then the end of that line in it
+            lines_left = 4 * num_records
+            k = 0
+            while lines_left > chunk_newlines_list[i][k]:
+                lines_left -= chunk_newlines_list[i][k]
+                k += 1
+            chunk = pending_chunks_list[i][k]
+            if lines_left == chunk_newlines_list[i][k] and chunk.endswith(b"\n"):
+                block_end = len(chunk)
+            else:
+                block_end = int(np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))[lines_left - 1]) + 1
+            raw_block.append(b"".join(pending_chunks_list[i][:k] + [chunk[:block_end]]))
+            pending_chunks_list[i] = ([chunk[block_end:]] if block_end < len(chunk) else []) + pending_chunks_list[i][k + 1:]
+            chunk_newlines_list[i] = ([chunk_newlines_list[i][k] - lines_left] if block_end < len(chunk) else []) + chunk_newlines_list[i][k + 1:]
+        yield raw_block
+
+def split_record_block(raw_block: list) -> list:
+    '''Splits a raw block (see get_raw_record_blocks) into a block: a list of lists (one per input file) of the lines of the block's records as bytes, without "\\n":
+        block[i][4*r + 0]: header line of record r from input file i
+        block[i][4*r + 1]: sequence line
+        block[i][4*r + 2]: "+" line
+        block[i][4*r + 3]: quality score line
+    Each file's lines are split in one bytes.split call, so no per-line readline/strip/decode is done. 
+    Raises a ValueError if the read names of the first and last record of the block don't match across all input files.'''
+    # local variables
+    block: list = []
+
+    for raw_lines in raw_block:
+        block.append(raw_lines.split(b"\n"))
+        block[-1].pop()     #every line ends in "\\n", so the last item is an empty string
+    if len(block[0]) == 0:
+        return block
+
+    #check that the files are still in sync: read names of the first and last record must match in all input files
+    for r in [0, len(block[0]) - 4]:
+        if len(set([get_read_name(block_lines[r]) for block_lines in block])) != 1:
+            raise ValueError("Input FASTQ files are out of sync at record: " + b" / ".join([block_lines[r] for block_lines in block]).decode("ascii", "replace"))
+    return block
+
+def get_record_blocks(input_filehandlers_list: list, batch_size: int, chunk_size: int = 1048576, max_records: int = 0):
+    '''Generator: reads the input files (opened in binary mode) in large chunks and yields blocks of up to batch_size records from each file (see get_raw_record_blocks), split into lines (see split_record_block).
+    If max_records > 0, no more than max_records records are yielded.
+    Raises a ValueError if the input files don't have the same number of records, or if the read names of the first and last record of a block don't match across all input files.'''
+    for raw_block in get_raw_record_blocks(input_filehandlers_list, batch_size, chunk_size, max_records):
+        yield split_record_block(raw_block)
+
+def get_low_quality_flags(qual_lines: list, quality_filter: dict) -> np.ndarray:
+    '''Takes a list of quality score lines and a quality filter dictionary (keys: "cutoff", "policy", "max_low_bases") and returns a NumPy array of bools, True for each line that fails the filter:
+        "min": any qscore is below the cutoff
+        "mean": mean qscore is below the cutoff (same as Bioinfo.qual_score)
+        "maxlow": more than max_low_bases qscores are below the cutoff
+    Lines (bytes) are checked all at once as a NumPy matrix of raw phred characters, instead of calling convert_phred on every character.'''
+    # local variables
+    line_len: int = 0
+    char_cutoff: int = quality_filter["cutoff"] + 33    #phred character value that corresponds to the qscore cutoff, so characters don't have to be converted
+    qual_data: bytes = b""  #all lines, each followed by "\n"
+    qual_matrix = None      #2D NumPy array (rows: lines, cols: nucleotide positions, then "\n") of phred character values
+    col_values = None       #1D NumPy array, one value per line: running min, sum or count of low qscores over the columns done so far
+    low_qual_flags = None   #1D NumPy array of bools, one per line
+
+    if len(qual_lines) == 0:
+        return np.zeros(0, dtype=bool)
+    line_len = len(qual_lines[0])
+
+    #the lines are joined with "\n" after each one, so they're all line_len long exactly when every row of the matrix ends in "\n". Checking that column is much faster than checking the length of every line
+    qual_data = b"\n".join(qual_lines) + b"\n"
+    if len(qual_data) == len(qual_lines) * (line_len + 1):
+        qual_matrix = np.frombuffer(qual_data, dtype=np.uint8).reshape(len(qual_lines), line_len + 1)
+    if qual_matrix is None or not (qual_matrix[:, line_len] == 10).all():
+        #lines of different lengths can't go in one matrix, so check them one at a time
+        return np.array([get_low_quality_flags([line], quality_filter)[0] for line in qual_lines], dtype=bool)
+    if line_len == 0:
+        return np.zeros(len(qual_lines), dtype=bool)
+
+    #the matrix is reduced one column (nucleotide position) at a time: NumPy is slow at reducing along short rows, and index reads are only ~8 bases long, so this is several times faster than e.g. qual_matrix.min(axis=1)
+    if quality_filter["policy"] == "mean":
+        #mean qscore < cutoff  is the same as  sum of phred characters < (cutoff + 33) * line length, which avoids any float division
+        col_values = qual_matrix[:, 0].astype(np.int64)
+        for col in range(1, line_len):
+            col_values += qual_matrix[:, col]
+        low_qual_flags = col_values < char_cutoff * line_len
+    elif quality_filter["policy"] == "maxlow":
+        col_values = np.zeros(len(qual_lines), dtype=np.int64)
+        for col in range(line_len):
+            col_values += qual_matrix[:, col] < char_cutoff
+        low_qual_flags = col_values > quality_filter["max_low_bases"]
+    else:
+        col_values = qual_matrix[:, 0].copy()
+        for col in range(1, line_len):
+            np.minimum(col_values, qual_matrix[:, col], out=col_values)
+        low_qual_flags = col_values < char_cutoff
+    return low_qual_flags
+
+def classify_batch(block: list, index_table: dict, quality_filter: dict) -> list:
+    '''Takes a block of records (see get_record_blocks) and returns a list [list holding the key of the output bucket each read-pair belongs in (a reference index sequence, "swapped", or "unknown_lowQ"), index pair counts].
+    Index pair counts is a 2D array (see get_index_pair_matrix) counting the read-pairs that passed the quality filter for each (index1 ID, index2 ID) pair.'''
+    # local variables
+    unknown_id: int = len(index_table["ref_index_seqs"])
+    index1_ids: dict = index_table["index1_ids"]
+    index2_ids: dict = index_table["index2_ids"]
+    pair_buckets: list = index_table["pair_buckets"]
+    low_qual_flags: np.ndarray = None   #True for each read-pair with a low-quality index1 or index2 record
+    #unknown indexes (including ones with Ns that weren't corrected) aren't in index1_ids/index2_ids, so they get the unknown ID
+    index1_id_array: np.ndarray = np.array([index1_ids.get(index1_seq, unknown_id) for index1_seq in block[2][1::4]], dtype=np.int64)
+    index2_id_array: np.ndarray = np.array([index2_ids.get(index2_seq, unknown_id) for index2_seq in block[3][1::4]], dtype=np.int64)
+    pair_codes: np.ndarray = index1_id_array * (unknown_id + 1) + index2_id_array  #flattened position of each read-pair's (index1 ID, index2 ID) cell in the pair matrix
+    buckets_list: list = []
+
+    #check qscores of both index records of every read-pair in the block
+    low_qual_flags = (
+        get_low_quality_flags(block[2][3::4], quality_filter)
+        | get_low_quality_flags(block[3][3::4], quality_filter)
+        )
+
+    for index1_id, index2_id, low_qual in zip(index1_id_array.tolist(), index2_id_array.tolist(), low_qual_flags.tolist()):
+        if low_qual:
+            buckets_list.append("unknown_lowQ")
+        else:
+            buckets_list.append(pair_buckets[index1_id][index2_id])
+    return [buckets_list, get_index_pair_matrix(index_table, pair_codes[~low_qual_flags])]
+
+def demultiplex_batch(block: list, index_table: dict, quality_filter: dict) -> list:
+    '''Sorts a block of records (see get_record_blocks) into output buckets. Returns a list [demultiplexed output, index pair counts (see classify_batch)].
+    Demultiplexed output is a dictionary with keys: bucket keys (see classify_batch), values: list [read1 FASTQ bytes, read2 FASTQ bytes, number of read-pairs] for the records in that bucket, in input order.
+    The read lines are written out exactly as they were read, except for the index sequences appended to each header line.'''
+    # local variables
+    r: int = 0      #line number of the header line of the current record in the block
+    header_tag: bytes = b""
+    bucket_lines_dict: dict = {}    #keys: bucket keys, values: list [list of read1 lines, list of read2 lines, number of read-pairs]
+    batch_output_dict: dict = {}    #keys: bucket keys, values: list [read1 FASTQ bytes, read2 FASTQ bytes, number of read-pairs]
+    buckets_list, index_pair_counts = classify_batch(block, index_table, quality_filter)
+
+    for record_num, bucket in enumerate(buckets_list):
+        r = 4 * record_num
+        #modify header lines of input biological read/record
+        header_tag = b" " + block[2][r + 1] + b"-" + block[3][r + 1]
+
+        if bucket not in bucket_lines_dict:
+            bucket_lines_dict[bucket] = [[], [], 0]
+        bucket_lines_dict[bucket][0].append(block[0][r] + header_tag)
+        bucket_lines_dict[bucket][0].extend(block[0][r + 1:r + 4])
+        bucket_lines_dict[bucket][1].append(block[1][r] + header_tag)
+        bucket_lines_dict[bucket][1].extend(block[1][r + 1:r + 4])
+        bucket_lines_dict[bucket][2] += 1
+
+    #join each bucket's lines into one block of bytes per output file, so each output file only gets 1 write per batch
+    for bucket in bucket_lines_dict:
+        batch_output_dict[bucket] = [
+            b"\n".join(bucket_lines_dict[bucket][0]) + b"\n",
+            b"\n".join(bucket_lines_dict[bucket][1]) + b"\n",
+            bucket_lines_dict[bucket][2]
+            ]
+    return [batch_output_dict, index_pair_counts]
+
+def init_worker(index_table: dict, quality_filter: dict, output_files_dict: dict = None, turn_condition = None, next_batch_value = None):
+    '''Runs once in each worker process: stores the index table and quality filter that every batch is classified against, and the output files the worker writes to (if any) with the shared values used to take turns writing them.'''
+    global _worker_index_table, _worker_quality_filter, _worker_output_files_dict, _worker_turn, _worker_next_batch, _worker_parent_pid
+    _worker_index_table = index_table
+    _worker_quality_filter = quality_filter
+    _worker_output_files_dict = output_files_dict if output_files_dict is not None else {}
+    _worker_turn = turn_condition
+    _worker_next_batch = next_batch_value
+    _worker_parent_pid = os.getppid()
+
+def demultiplex_batch_in_worker(raw_block: list, batch_num: int = 0) -> list:
+    '''Splits a raw block (see get_raw_record_blocks) into lines and runs demultiplex_batch on it in a worker process, using the values stored by init_worker. Returns a list [demultiplex_batch result, seconds classifying, seconds writing].
+    Only the raw block (4 bytes objects) and the formatted output go between processes; splitting the block into hundreds of thousands of line objects here instead of in the main process keeps them out of pickling.
+    If init_worker was given output files, the worker appends the output itself once every earlier batch (batch_num counts from 0) has been written, so the files stay in input order,
+    and only the number of bytes written to each file goes back (values of the demultiplexed output: [read1 bytes written, read2 bytes written, number of read-pairs]).'''
+    # local variables
+    start_time: float = time.perf_counter()
+    batch_result: list = demultiplex_batch(split_record_block(raw_block), _worker_index_table, _worker_quality_filter)
+    classify_seconds: float = time.perf_counter() - start_time
+    write_seconds: float = 0
+
+    if len(_worker_output_files_dict) > 0:
+        with _worker_turn:
+            _worker_turn.wait_for(lambda: _worker_next_batch.value == batch_num)
+            if os.getppid() != _worker_parent_pid:
+                #the main process was killed: a rerun with --resume may already be truncating the output files, so this worker must not add to them
+                sys.exit(1)
+            start_time = time.perf_counter()
+            for bucket, bucket_output in batch_result[0].items():
+                #files are opened for each write, so workers never hold more than 1 output file open
+                for output_file, data in zip(_worker_output_files_dict[bucket], bucket_output[:2]):
+                    with open(output_file, "ab") as output_fh:
+                        output_fh.write(data)
+                batch_result[0][bucket] = [len(bucket_output[0]), len(bucket_output[1]), bucket_output[2]]
+            write_seconds = time.perf_counter() - start_time
+            _worker_next_batch.value += 1
+            _worker_turn.notify_all()
+    return [batch_result, classify_seconds, write_seconds]
+
+def get_timed_record_blocks(input_fh_list: list, batch_size: int, max_records: int, metrics: demux_metrics.RunMetrics, raw: bool = False):
+    '''Generator: yields the blocks of get_record_blocks (or the raw blocks of get_raw_record_blocks if raw is True), adding the time spent getting each one (reading, splitting, waiting on decompression) to the "read" timer of metrics.'''
+    # local variables
+    block_generator = get_raw_record_blocks(input_fh_list, batch_size, max_records=max_records) if raw else get_record_blocks(input_fh_list, batch_size, max_records=max_records)
+    start_time: float = 0
+    block: list = []
+
+    while True:
+        start_time = time.perf_counter()
+        block = next(block_generator, None)
+        metrics.add_time("read", time.perf_counter() - start_time)
+        if block is None:
+            return
+        yield block
+
+def demultiplex_batches(input_fh_list: list, index_table: dict, quality_filter: dict, workers: int, batch_size: int, metrics: demux_metrics.RunMetrics = None, max_records: int = 0, output_files_dict: dict = None):
+    '''Generator: reads the 4 input files block by block, stopping after max_records records if max_records > 0 (see get_record_blocks), and yields the demultiplex_batch result of each block, in input order. 
+    If workers > 1, this process only reads raw blocks (see get_raw_record_blocks) and writes the output; the workers split, classify, and format them (see demultiplex_batch_in_worker). At most 2 blocks per worker are in flight at a time, so memory use stays bounded.
+    If output_files_dict is also given, the workers append the output to those files themselves, taking turns so the files stay in input order, and the output never comes back to this process:
+    the yielded results then hold the number of bytes written to each file instead of the data (see demultiplex_batch_in_worker).
+    Time spent reading and classifying is added to the "read" and "classify" timers of metrics (with workers, "classify" is the workers' total time, and time this process spends waiting for them goes to "wait_for_workers"; the workers' time writing goes to "write").'''
+    # local variables
+    pending_results: deque = deque()    #holds AsyncResults of blocks handed to the worker pool, oldest first
+    start_time: float = 0
+    batch_result: list = []
+    worker_result: list = []
+    turn_condition = None               #multiprocessing.Condition the workers wait on for their turn to write
+    next_batch_value = None             #multiprocessing.Value: number of the next batch to be written
+
+    if metrics is None:
+        metrics = demux_metrics.RunMetrics()
+
+    if workers <= 1:
+        for block in get_timed_record_blocks(input_fh_list, batch_size, max_records, metrics):
+            start_time = time.perf_counter()
+            batch_result = demultiplex_batch(block, index_table, quality_filter)
+            metrics.add_time("classify", time.perf_counter() - start_time)
+            yield batch_result
+        return
+
+    turn_condition = multiprocessing.Condition()
+    next_batch_value = multiprocessing.Value("q", 0)
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(index_table, quality_filter, output_files_dict, turn_condition, next_batch_value)) as pool:
+        for batch_num, raw_block in enumerate(get_timed_record_blocks(input_fh_list, batch_size, max_records, metrics, raw=True)):
+            pending_results.append(pool.apply_async(demultiplex_batch_in_worker, (raw_block, batch_num)))
+            #results are collected in the order blocks were submitted, so output files are written in input order
+            if len(pending_results) >= 2 * workers:
+                start_time = time.perf_counter()
+                worker_result = pending_results.popleft().get()
+                metrics.add_time("wait_for_workers", time.perf_counter() - start_time)
+                metrics.add_time("classify", worker_result[1])
+                metrics.add_time("write", worker_result[2])
+                yield worker_result[0]
+        while len(pending_results) > 0:
+            start_time = time.perf_counter()
+            worker_result = pending_results.popleft().get()
+            metrics.add_time("wait_for_workers", time.perf_counter() - start_time)
+            metrics.add_time("classify", worker_result[1])
+            metrics.add_time("write", worker_result[2])
+            yield worker_result[0]
+
+def write_checkpoint(checkpoint_filename: str, checkpoint_dict: dict):
+    '''Writes a checkpoint dictionary (see parse_input_files) to a JSON file. The file is written under a temporary name and then renamed, so a run killed mid-write never leaves a half-written checkpoint behind.'''
+    with open(checkpoint_filename + ".tmp", "w") as checkpoint_fh:
+        json.dump(checkpoint_dict, checkpoint_fh, indent=1)
+    os.replace(checkpoint_filename + ".tmp", checkpoint_filename)
+
+def get_run_settings(read1_file: str, read2_file: str, index1_file: str, index2_file: str, index_table: dict, output_files_dict: dict, quality_filter: dict, io_options: dict) -> dict:
+    '''Returns a dictionary of the settings that decide a run's results (input/output files, where output goes ("files", or the class name of io_options["bucket_writer"] for streamed output), reference indexes and mismatches allowed, quality filter, compression, record range), 
+    so checkpoints and stats files are only reused by runs with the same settings (see load_checkpoint and load_lane_results).'''
+    return {
+        "input_files": [read1_file, read2_file, index1_file, index2_file], 
+        "output_files": output_files_dict, 
+        "output_sink": type(io_options["bucket_writer"]).__name__ if io_options.get("bucket_writer") is not None else "files", 
+        "ref_indexes": [index_table["ref_index_names"], index_table["ref_index_seqs"]], 
+        "max_mismatches": index_table["max_mismatches"], 
+        "quality_filter": quality_filter, 
+        "compress": io_options.get("compress", False), 
+        "record_range": io_options.get("record_range", [0, 0])
+        }
+
+def load_checkpoint(checkpoint_filename: str, run_settings_dict: dict) -> dict:
+    '''Reads a checkpoint file written by write_checkpoint, and truncates every output file back to the size it had at the checkpoint. Returns the checkpoint dictionary.
+    Raises a ValueError if the checkpoint was written by a run with different settings (input/output files, quality filter, etc.) than run_settings_dict.'''
+    # local variables
+    checkpoint_dict: dict = {}
+
+    with open(checkpoint_filename, "r") as checkpoint_fh:
+        checkpoint_dict = json.load(checkpoint_fh)
+    if checkpoint_dict["run_settings"] != run_settings_dict:
+        raise ValueError("Checkpoint " + checkpoint_filename + " was written by a run with different settings, can't resume from it")
+
+    for output_file, output_size in checkpoint_dict["output_sizes"].items():
+        os.truncate(output_file, output_size)
+    return checkpoint_dict
+
+def parse_input_files(read1_file: str, read2_file: str, index1_file: str, index2_file: str, index_table: dict, output_files_dict: dict, quality_filter: dict, workers: int = 1, batch_size: int = 10000, io_options: dict = None, metrics: demux_metrics.RunMetrics = None):
+    '''Takes 2 FASTQ read files and 2 FASTQ index files and demultiplexes them based on a given index table (see get_index_table) and based on a given index quality filter (see get_low_quality_flags).
+    Records are processed in batches of batch_size read-pairs; if workers > 1, batches are classified by that many worker processes (see demultiplex_batches).
+    io_options holds input/output settings (keys: "decompress_command", "prefetch_chunks", "compress", "compress_level", "compress_threads", "buffer_bytes", "max_open_files", "checkpoint_records", "resume", "record_range", "bucket_writer"). Each input file is decompressed on its own thread (see demux_io.PrefetchReader).
+    If "bucket_writer" is given (a demux_io.FifoBucketWriter, InterleavedBucketWriter, CallbackBucketWriter, or any object with the same methods), output goes to it instead of to the output files of output_files_dict, 
+    so reads can be streamed to the next tool as they're demultiplexed; streamed output can't be taken back, so those runs don't write checkpoints and can't be resumed.
+    If "record_range" is a list [first record, end record], only records first record (counting from 0) up to but not including end record (0: the end of the files) are demultiplexed; input files with a seek index (see demux_gzindex) are opened right at the first record.
+    Output is buffered and written by a demux_io.BucketWriter, except with several workers and uncompressed output files, where the workers append their batches to the files themselves (see demultiplex_batches); if "compress" is True the output files are written as BGZF files, with blocks compressed by a thread pool shared by all output files (see demux_io.BgzfWriter).
+    Every "checkpoint_records" read-pairs, all output is flushed and a checkpoint (number of read-pairs done, output file sizes, bucket counters, index pair matrix) is written to demux_checkpoint.json. 
+    If "resume" is True, the run continues from that checkpoint instead of starting over.
+    Time spent in each stage ("read", "decompress", "classify", "write", "checkpoint", ...) and record/byte counts are kept in metrics (see demux_metrics.RunMetrics), which reports progress as the run goes. 
+    The final totals are written to demux_metrics.json, and the bucket counters and index pair matrix to demux_stats.json (see write_stats_file), which write_report renders into demux_final_report.tsv, demux_final_plot.png, and demux_index_pair_matrix.tsv/.npy.
+    Returns a dictionary with keys: "record_counters" (keys: bucket keys, values: number of read-pairs), "index_pair_matrix".'''
     # local variables
-    is_index_qscore_below_cutoff: bool = False
-
-    temp_records_list: list = []
-    #2D list of strings (4 rows, 4 cols) to temporarily hold a record from each of the 4 input files  
-        #record_list[0]: holds record for input biological read file 1
-        #record_list[1]: holds record for input biological read file 2
-        #record_list[2]: holds record for input index read file 1
-        #record_list[3]: holds record for input index read file 2
-        #for each record from an input file, 
-            #record_list[i][0]: holds header line
-            #record_list[i][1]: holds sequence line
-            #record_list[i][2]: holds "+" line
-            #record_list[i][3]: holds quality score line
     input_fh_list: list = []    #holds the filehandlers for each of the 4 input FASTQ files
-    output_fh_dict: dict = {}   #keys: holds index sequences of each reference index from output_files_dict. For swapped and unknown/low-qscore files, key holds "swapped" or "unknown_lowQ".
-                                #values: In a list w/2 elements (element 0 for read1 filehandlers, element 1 for read2 filehandlers), holds all the filehandlers of output files that get opened
+    compress_executor = None    #thread pool that compresses output blocks, if output is compressed
+    bucket_writer = None        #demux_io.BucketWriter that buffers and writes all output files
+    workers_write_output: bool = False  #True if the worker processes append the output to the output files themselves
+    output_sizes_dict: dict = {}    #keys: output filenames, values: size in bytes after the batches done so far (only kept when the workers write the output)
     record_counters_dict: dict = {} #keys: holds index sequences of each reference index from output_files_dict. For swapped and unknown/low-qscore files, key holds "swapped" or "unknown_lowQ".
                                     #values: Holds an integer counter of number of read-pairs with each index sequence. 
-    record_counts_filename: str = "demux_final_report.tsv"
+    batch_output_dict: dict = {}    #keys: bucket keys, values: list [read1 FASTQ bytes, read2 FASTQ bytes, number of read-pairs] (see demultiplex_batch)
+    index_pair_matrix: np.ndarray = get_index_pair_matrix(index_table)  #read-pair counts for every (index1 ID, index2 ID) pair (see get_index_pair_matrix)
+    stats_filename: str = "demux_stats.json"
+    metrics_filename: str = "demux_metrics.json"
     read_record_count: int = 0  #holds count of number of records read from input read files
+    start_time: float = 0
+    checkpoint_filename: str = "demux_checkpoint.json"
+    record_range: list = []             #[first record, end record] of the part of the input files to demultiplex
+    max_records: int = 0                #number of read-pairs left to demultiplex (0: all of them)
+    checkpoint_records: int = 0         #number of read-pairs between checkpoints (0: no checkpoints)
+    next_checkpoint_count: int = 0      #record count at which the next checkpoint gets written
+    run_settings_dict: dict = {}        #settings a checkpoint or stats file is only valid for (see get_run_settings)
+    checkpoint_dict: dict = {}          #keys: "run_settings", "records_done", "record_counters", "index_pair_matrix", "output_sizes" (keys: output filenames, values: file sizes in bytes)
 
-    sum_of_reads: int = 0
-    percent_of_reads: float = 0
-
-    #initialize values of output_fh_dict
-    for key in output_files_dict:
-        if key not in output_fh_dict:
-            output_fh_dict[key] = []  
+    if io_options is None:
+        io_options = {}
+    if metrics is None:
+        metrics = demux_metrics.RunMetrics()
+    record_range = io_options.get("record_range", [0, 0])
+    if io_options.get("bucket_writer") is not None:
+        if io_options.get("resume", False):
+            raise ValueError("Can't resume a run whose output is streamed (named pipes, stdout or a callback)")
+        io_options = dict(io_options, checkpoint_records=0)
 
     #initialize values of record_counters_dict
     for key in output_files_dict:
         if key not in record_counters_dict:
             record_counters_dict[key] = 0
+
+    #pick up where the last checkpoint left off: output files get truncated back to their size at the checkpoint
+    run_settings_dict = get_run_settings(read1_file, read2_file, index1_file, index2_file, index_table, output_files_dict, quality_filter, io_options)
+    if io_options.get("resume", False) and not os.path.exists(checkpoint_filename):
+        #killed before the first checkpoint: nothing to resume from
+        print("No checkpoint found, starting from the first record", file=sys.stderr)
+        io_options = dict(io_options, resume=False)
+    if io_options.get("resume", False):
+        checkpoint_dict = load_checkpoint(checkpoint_filename, run_settings_dict)
+        read_record_count = checkpoint_dict["records_done"]
+        record_counters_dict = checkpoint_dict["record_counters"]
+        index_pair_matrix = np.array(checkpoint_dict["index_pair_matrix"], dtype=np.int64)
+        metrics.set_count("resumed_from_record", read_record_count)
+        print("Resuming from checkpoint at record: ", read_record_count, file=sys.stderr)
+    checkpoint_records = io_options.get("checkpoint_records", 0)
+    next_checkpoint_count = read_record_count + checkpoint_records
+    if record_range[1] > 0:
+        max_records = record_range[1] - record_range[0] - read_record_count
     
-    #open all gzipped FASTQ read and index files
-    read1_fh = gzip.open(read1_file, "rt")
-    read2_fh = gzip.open(read2_file, "rt")
-    index1_fh = gzip.open(index1_file, "rt")
-    index2_fh = gzip.open(index2_file, "rt")
-    input_fh_list = [read1_fh, read2_fh, index1_fh, index2_fh]
-    
-    #open all output files for writing
-    for ref_index_seq in output_files_dict:
-        for output_file in output_files_dict[ref_index_seq]:
-            #fh = gzip.open(output_file, 'wt')
-            fh = open(output_file, "w") #much faster than outputting/writing into gzipped files
-            output_fh_dict[ref_index_seq].append(fh)
-
-    #demultiplex each biological read record in each input file
-    while True:    
-        temp_records_list = get_record(input_fh_list)
-        is_index_qscore_below_cutoff = False
-        
-        #if EOF has been reached:
-        if temp_records_list[0][0] == "":
-            break
+    #a stats file from an earlier run stops describing the output files as soon as this run starts writing them, so it's removed here; only a run that finishes writes a new one (see load_lane_results)
+    if os.path.exists(stats_filename):
+        os.remove(stats_filename)
+
+    #open all gzipped FASTQ read and index files in binary mode, so lines never get decoded/re-encoded. Each file gets decompressed on its own thread, starting at the first record not demultiplexed yet.
+    for input_file in [read1_file, read2_file, index1_file, index2_file]:
+        input_fh_list.append(demux_io.PrefetchReader(input_file, io_options.get("decompress_command", ""), queue_size=io_options.get("prefetch_chunks", 8), start_record=record_range[0] + read_record_count))
     
-        read_record_count += 1
-        if read_record_count % 1000000 == 0:
-            print("Records read: ", read_record_count)
-            print("Lines read: ", 4 * read_record_count)
-            print()
+    #create all output files for writing, unless output is streamed somewhere else
+    if io_options.get("bucket_writer") is not None:
+        bucket_writer = io_options["bucket_writer"]
+    else:
+        if io_options.get("compress", False):
+            #BGZF blocks are compressed in parallel on the thread pool (gzip.open(output_file, 'wb') compresses on this thread, which was much slower)
+            compress_executor = concurrent.futures.ThreadPoolExecutor(max_workers=io_options.get("compress_threads", 4))
+        bucket_writer = demux_io.BucketWriter(
+            output_files_dict, 
+            io_options.get("buffer_bytes", 67108864), 
+            io_options.get("max_open_files", 0), 
+            io_options.get("compress", False), 
+            io_options.get("compress_level", 6), 
+            compress_executor, 
+            append=io_options.get("resume", False)
+            )
+        #with several workers, sending every batch's output back to this process to be written makes this process the bottleneck, so the workers write it (BucketWriter still creates/empties the files).
+        #The workers may be ahead of the batches this process has seen, so checkpoints use the sizes added up from the batches done, not the sizes of the files
+        if workers > 1 and not io_options.get("compress", False):
+            workers_write_output = True
+            output_sizes_dict = {output_file: os.path.getsize(output_file) for bucket in output_files_dict for output_file in output_files_dict[bucket]}
 
-        #modify header lines of input biological read/record
-        temp_records_list[0][0] += " " + temp_records_list[2][1] + "-" + temp_records_list[3][1]
-        temp_records_list[1][0] += " " + temp_records_list[2][1] + "-" + temp_records_list[3][1]
-        
-        #check if any qscore in any index records is below qscore threshold
-        for char in temp_records_list[2][3]:
-            if convert_phred(char) < qscore_cutoff:
-                is_index_qscore_below_cutoff = True
-                break
-        for char in temp_records_list[3][3]:
-            if convert_phred(char) < qscore_cutoff:
-                is_index_qscore_below_cutoff = True
-                break
-
-        if (
-            ("N" in temp_records_list[2][1] or "N" in temp_records_list[3][1])
-            or (temp_records_list[2][1] not in ref_indexes_dict or rev_comp(temp_records_list[3][1]) not in ref_indexes_dict)
-            or (is_index_qscore_below_cutoff == True)
-            ):
-            
-            #write each biological read/record to corresponding unknown_lowQ output file
-            for i in range(2):
-                for j in range(4):
-                    output_fh_dict["unknown_lowQ"][i].write(temp_records_list[i][j] + "\n")
-                    #print(temp_records_list[i][j])
-
-            #increment counter
-            record_counters_dict["unknown_lowQ"] += 1
+    #demultiplex each biological read record in each input file, one batch at a time
+    try:
+        for batch_output_dict, batch_index_pair_counts in demultiplex_batches(input_fh_list, index_table, quality_filter, workers, batch_size, metrics, max_records, output_files_dict if workers_write_output else None):
+            start_time = time.perf_counter()
+            index_pair_matrix += batch_index_pair_counts
+            for bucket in batch_output_dict:
+                #write each biological read/record to corresponding output bucket file (or add up what the workers wrote), and increment counter of records for that bucket
+                if workers_write_output:
+                    for output_file, num_bytes in zip(output_files_dict[bucket], batch_output_dict[bucket][:2]):
+                        output_sizes_dict[output_file] += num_bytes
+                else:
+                    bucket_writer.write(bucket, batch_output_dict[bucket][0], batch_output_dict[bucket][1])
+                record_counters_dict[bucket] += batch_output_dict[bucket][2]
+                read_record_count += batch_output_dict[bucket][2]
+                metrics.add_count("records", batch_output_dict[bucket][2])
+            metrics.add_time("write", time.perf_counter() - start_time)
 
-        else:
-            if temp_records_list[2][1] == rev_comp(temp_records_list[3][1]):
-                #Write each biological read/record to corresponding output bucket file
-                for i in range(2):
-                    for j in range(4):
-                        output_fh_dict[temp_records_list[2][1]][i].write(temp_records_list[i][j] + "\n")
-                        #print(temp_records_list[i][j])
-
-                #Increment counter of records in for corresponding bucket (<bucket>_counter += 1)
-                record_counters_dict[temp_records_list[2][1]] += 1
-            else:
-                # Write record to appropriate "swapped" output file
-                for i in range(2):
-                    for j in range(4):
-                        output_fh_dict["swapped"][i].write(temp_records_list[i][j] + "\n")
-                        #print(temp_records_list[i][j])
-                        
-                # Increment counter of records for swapped reads
-                record_counters_dict["swapped"] += 1
+            #report progress (input_bytes: decompressed bytes read from all 4 input files so far. Decompression runs on the input threads at the same time as the other stages, so its timer is the total across all 4 threads)
+            metrics.set_count("input_bytes", sum([input_fh.bytes_read for input_fh in input_fh_list]))
+            metrics.set_time("decompress", sum([input_fh.decompress_seconds for input_fh in input_fh_list]))
+            metrics.report_progress()
+
+            if checkpoint_records > 0 and read_record_count >= next_checkpoint_count:
+                start_time = time.perf_counter()
+                #everything up to read_record_count has to be on disk before the checkpoint says so. This writes out (and with --compress, compresses) all buffered output, so it's timed as "write", not "checkpoint"
+                bucket_writer.flush()
+                metrics.add_time("write", time.perf_counter() - start_time)
+                start_time = time.perf_counter()
+                checkpoint_dict = {
+                    "run_settings": run_settings_dict, 
+                    "records_done": read_record_count, 
+                    "record_counters": record_counters_dict, 
+                    "index_pair_matrix": index_pair_matrix.tolist(), 
+                    "output_sizes": output_sizes_dict if workers_write_output else bucket_writer.get_output_sizes()
+                    }
+                write_checkpoint(checkpoint_filename, checkpoint_dict)
+                next_checkpoint_count = read_record_count + checkpoint_records
+                metrics.add_time("checkpoint", time.perf_counter() - start_time)
+    except BaseException:
+        #a run that fails or is interrupted (Ctrl-C, or SIGTERM, see main) never gets to close its output. Named pipes would be left in the output directory, so they're removed here
+        if isinstance(bucket_writer, demux_io.FifoBucketWriter):
+            bucket_writer.remove_fifos()
+        raise
 
     #close all FASTQ read and index files, and all output files
-    read1_fh.close()
-    read2_fh.close()
-    index1_fh.close()
-    index2_fh.close()
-    for ref_index_seq in output_fh_dict:
-        for output_fh in output_fh_dict[ref_index_seq]:
-            output_fh.close()
-
-    #write final demux stats to output TSV file
-    with open(record_counts_filename, "w") as output_stats_fh:
-        output_stats_fh.write("Bucket" + "\t" + "Number_of_Read_Pairs" + "\t" + "Percentage_of_Reads" + "\n")
-        
-        sum_of_reads = sum(list(record_counters_dict.values()))
-        for index_seq in record_counters_dict:
-            percent_of_reads = (record_counters_dict[index_seq] / sum_of_reads) * 100
-            output_stats_fh.write(index_seq + "\t" + str(record_counters_dict[index_seq]) + "\t" + str(percent_of_reads) + "\n")
-        
-        output_stats_fh.write("\nTotal_read_pairs:\t" + str(sum_of_reads) + "\n")
-        
-    #plot distribution of read-pairs from each bucket
-    plt.bar(list(record_counters_dict.keys()), list(record_counters_dict.values()), color="darkcyan")
-    plt.title("Number of Read-Pairs in each Index Bucket Category")
+    for input_fh in input_fh_list:
+        input_fh.close()
+    start_time = time.perf_counter()
+    bucket_writer.close()
+    if compress_executor is not None:
+        compress_executor.shutdown()
+    metrics.add_time("write", time.perf_counter() - start_time)
+
+    #save final bucket counters and counts of every index1/index2 combination (read-pairs that passed the quality filter), so the reports can be rendered from them (see write_report)
+    write_stats_file(stats_filename, {
+        "report_type": "final", 
+        "run_settings": run_settings_dict, 
+        "record_counters": record_counters_dict, 
+        "index_pair_matrix": index_pair_matrix.tolist(), 
+        "index_pair_labels": get_index_pair_labels(index_table)
+        })
+
+    metrics.set_time("decompress", sum([input_fh.decompress_seconds for input_fh in input_fh_list]))
+    metrics.report_progress(force=True)
+    metrics.write_summary(metrics_filename)
+
+    #run finished (counts saved), so there's nothing left to resume
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+    return {"record_counters": record_counters_dict, "index_pair_matrix": index_pair_matrix}
+
+def get_sample_blocks(index1_file: str, index2_file: str, sample_size: int, sample_method: str, batch_size: int, seed: int = 1):
+    '''Generator: reads a sample of sample_size records from the 2 index files and yields it in blocks of up to batch_size records (blocks of 2 lists of lines, see get_record_blocks).
+    sample_method is "head" (the first records), "stride" (evenly spaced slices starting at seek points of the files' seek indexes, see demux_gzindex; the caller has to check both files have one),
+    or "reservoir" (reads both files to the end and keeps a uniform random sample, chosen with the given seed; only the sequence and qscore lines of sampled records are kept).'''
+    # local variables
+    offsets_dict: dict = {}     #record offsets of index1's seek index (see demux_gzindex.build_seek_index)
+    num_records: int = 0
+    num_points: int = 0
+    slices_list: list = []      #list of [first record, end record] of each slice to read
+    slice_size: int = 0
+    input_fh_list: list = []
+    rng = np.random.default_rng(seed)
+    reservoir_list: list = []   #holds [index1 seq line, index1 qscore line, index2 seq line, index2 qscore line] of each sampled record
+    records_seen: int = 0
+    accepted_array: np.ndarray = None
+
+    if sample_method == "head":
+        slices_list = [[0, sample_size]]
+    elif sample_method == "stride":
+        #slices start at seek points, so no records have to be skipped to reach them; at least ~1000 records per slice, so each seek is worth it
+        offsets_dict = demux_gzindex.load_seek_index(index1_file)
+        num_records = min(offsets_dict["num_records"], demux_gzindex.load_seek_index(index2_file)["num_records"])
+        num_points = min(len(offsets_dict["record_offsets"]), len(demux_gzindex.load_seek_index(index2_file)["record_offsets"]))
+        point_nums = sorted(set(np.linspace(0, num_points - 1, max(1, min(num_points, sample_size // 1000))).round().astype(int).tolist()))
+        if sample_size >= num_records:
+            point_nums = []
+            slices_list = [[0, num_records]]   #the sample is the whole file
+        for slice_num, point_num in enumerate(point_nums):
+            slice_size = sample_size * (slice_num + 1) // len(point_nums) - sample_size * slice_num // len(point_nums)   #spreads the remainder of sample_size / number of slices over the slices
+            #each slice ends before the next one starts (and at the end of the files), so no record is sampled twice
+            slices_list.append([
+                point_num * offsets_dict["records_per_point"], 
+                min(point_num * offsets_dict["records_per_point"] + slice_size, point_nums[slice_num + 1] * offsets_dict["records_per_point"] if slice_num + 1 < len(point_nums) else num_records, num_records)
+                ])
+    
+    if sample_method != "reservoir":
+        for first_record, end_record in slices_list:
+            input_fh_list = [demux_io.PrefetchReader(index_file, queue_size=2, start_record=first_record) for index_file in [index1_file, index2_file]]
+            yield from get_record_blocks(input_fh_list, batch_size, max_records=end_record - first_record)
+            for input_fh in input_fh_list:
+                input_fh.close()
+        return
+
+    #reservoir sampling (algorithm R): record number i (counting from 1) replaces a random sampled record with probability sample_size / i
+    input_fh_list = [demux_io.PrefetchReader(index_file) for index_file in [index1_file, index2_file]]
+    for block in get_record_blocks(input_fh_list, batch_size):
+        accepted_array = np.nonzero(rng.random(len(block[0]) // 4) < sample_size / np.arange(records_seen + 1, records_seen + len(block[0]) // 4 + 1))[0]
+        for r in (4 * accepted_array).tolist():
+            if len(reservoir_list) < sample_size:
+                reservoir_list.append([block[0][r + 1], block[0][r + 3], block[1][r + 1], block[1][r + 3]])
+            else:
+                reservoir_list[rng.integers(sample_size)] = [block[0][r + 1], block[0][r + 3], block[1][r + 1], block[1][r + 3]]
+        records_seen += len(block[0]) // 4
+    for input_fh in input_fh_list:
+        input_fh.close()
+    for first_record in range(0, len(reservoir_list), batch_size):
+        yield [
+            [line for record in reservoir_list[first_record:first_record + batch_size] for line in [b"", record[0], b"+", record[1]]],
+            [line for record in reservoir_list[first_record:first_record + batch_size] for line in [b"", record[2], b"+", record[3]]]
+            ]
+
+def get_wilson_interval(count: int, total: int, z: float = 1.96) -> list:
+    '''Returns a list [lower bound, upper bound] of the Wilson score confidence interval (95% for z = 1.96) of the fraction count / total.'''
+    # local variables
+    fraction: float = count / max(total, 1)
+    center: float = (fraction + z * z / (2 * max(total, 1))) / (1 + z * z / max(total, 1))
+    half_width: float = z * (fraction * (1 - fraction) / max(total, 1) + z * z / (4 * max(total, 1) ** 2)) ** 0.5 / (1 + z * z / max(total, 1))
+
+    return [max(0, center - half_width), min(1, center + half_width)]
+
+def sample_input_files(index1_file: str, index2_file: str, index_table: dict, buckets_list: list, quality_filter: dict, sample_size: int, sample_method: str = "stride", batch_size: int = 10000, seed: int = 1) -> dict:
+    '''Estimates the bucket distribution of a lane from a sample of sample_size read-pairs (see get_sample_blocks), classified exactly like parse_input_files does. Only the index files are read and no FASTQ files are written.
+    The counts of each bucket in buckets_list and the index pair matrix are saved to demux_sample_stats.json (see write_stats_file), which write_report renders into demux_sample_report.tsv and demux_sample_plot.png (with 95% confidence intervals) and demux_sample_index_pair_matrix.tsv/.npy.
+    "stride" falls back to "head" if either index file has no seek index. Returns a dictionary in the same form parse_input_files returns.'''
+    # local variables
+    record_counters_dict: dict = {bucket: 0 for bucket in buckets_list}    #keys: bucket keys, values: number of sampled read-pairs in that bucket
+    index_pair_matrix: np.ndarray = get_index_pair_matrix(index_table)
+    buckets_in_block: list = []
+    block_index_pair_counts: np.ndarray = None
+
+    if sample_method == "stride" and (demux_gzindex.load_seek_index(index1_file) is None or demux_gzindex.load_seek_index(index2_file) is None):
+        print("No seek index for " + index1_file + " and " + index2_file + " (see demux_gzindex.py), sampling the first records instead", file=sys.stderr)
+        sample_method = "head"
+
+    for block in get_sample_blocks(index1_file, index2_file, sample_size, sample_method, batch_size, seed):
+        buckets_in_block, block_index_pair_counts = classify_batch([[], [], block[0], block[1]], index_table, quality_filter)
+        for bucket in buckets_in_block:
+            record_counters_dict[bucket] += 1
+        index_pair_matrix += block_index_pair_counts
+    if sum(list(record_counters_dict.values())) < sample_size:
+        print("Sampled " + str(sum(list(record_counters_dict.values()))) + " read-pairs, fewer than the " + str(sample_size) + " asked for (the input files don't have that many records, or slices were cut short at the end of the files or at the next slice)", file=sys.stderr)
+
+    write_stats_file("demux_sample_stats.json", {
+        "report_type": "sample", 
+        "record_counters": record_counters_dict, 
+        "index_pair_matrix": index_pair_matrix.tolist(), 
+        "index_pair_labels": get_index_pair_labels(index_table), 
+        "sample_method": sample_method
+        })
+    return {"record_counters": record_counters_dict, "index_pair_matrix": index_pair_matrix}
+
+def write_stats_file(stats_filename: str, stats_dict: dict):
+    '''Writes the results of a run to a JSON stats file (keys: "report_type" (see REPORT_FILENAMES_DICT), "run_settings" (see get_run_settings, full runs only), "record_counters", "index_pair_matrix" (as a list of rows), "index_pair_labels", and "sample_method" for samples), 
+    so the reports can be rendered from it by write_report, in the same run or later. Like checkpoints, it's written under a temporary name and then renamed.'''
+    with open(stats_filename + ".tmp", "w") as stats_fh:
+        json.dump(stats_dict, stats_fh)
+    os.replace(stats_filename + ".tmp", stats_filename)
+
+def load_stats_file(stats_filename: str) -> dict:
+    '''Reads a stats file written by write_stats_file. Returns the stats dictionary, with the index pair matrix as a 2D array.'''
+    # local variables
+    stats_dict: dict = {}
+
+    with open(stats_filename, "r") as stats_fh:
+        stats_dict = json.load(stats_fh)
+    stats_dict["index_pair_matrix"] = np.array(stats_dict["index_pair_matrix"], dtype=np.int64)
+    return stats_dict
+
+def plot_bucket_counts(plot_filename: str, record_counters_dict: dict, ci_errors_list: list = None, sample_method: str = ""):
+    '''Plots the number of read-pairs in each bucket to plot_filename. If ci_errors_list is given (distances from each bucket's percentage down/up to its confidence interval bounds), 
+    the counts are from a sample (see sample_input_files), so the estimated percentage of read-pairs in each bucket is plotted instead, with the confidence intervals as error bars.'''
+    #imported here instead of at the top, so runs that don't render reports never load matplotlib
+    import matplotlib.pyplot as plt
+    # local variables
+    sum_of_reads: int = sum(list(record_counters_dict.values()))
+
+    plt.figure()
+    if ci_errors_list is None:
+        plt.bar(list(record_counters_dict.keys()), list(record_counters_dict.values()), color="darkcyan")
+        plt.title("Number of Read-Pairs in each Index Bucket Category")
+        plt.ylabel("Number of Read Pairs")
+    else:
+        plt.bar(list(record_counters_dict.keys()), [count / max(sum_of_reads, 1) * 100 for count in record_counters_dict.values()], yerr=ci_errors_list, capsize=2, color="darkcyan")
+        plt.title("Estimated Percentage of Read-Pairs in each Index Bucket Category\n(sample of " + str(sum_of_reads) + " read-pairs, " + sample_method + ", 95% CI)")
+        plt.ylabel("Percentage of Read Pairs")
     plt.xlabel("Index Bucket")
-    plt.ylabel("Number of Read Pairs")
     plt.xticks(rotation=-90)    #rotate x-labels
-    plt.savefig("demux_final_plot.png", bbox_inches="tight")    #bbox_inches="tight" makes the entire figure visible so it doesn't get cut off if labels are too long
+    plt.savefig(plot_filename, bbox_inches="tight")    #bbox_inches="tight" makes the entire figure visible so it doesn't get cut off if labels are too long
+    plt.close()
+
+def write_report(stats_filename: str, plot: bool = True):
+    '''Renders the reports of a stats file (see write_stats_file) into the stats file's directory: the bucket report TSV (read-pairs in each bucket and percentage of all read-pairs, plus 95% confidence intervals for samples), 
+    the index pair matrix TSV/.npy (see write_index_pair_matrix), and, if plot is True, the bucket plot PNG (see plot_bucket_counts). Filenames depend on the stats file's report type (see REPORT_FILENAMES_DICT).'''
+    # local variables
+    stats_dict: dict = load_stats_file(stats_filename)
+    report_filenames_list: list = [os.path.join(os.path.dirname(stats_filename), filename) for filename in REPORT_FILENAMES_DICT[stats_dict["report_type"]]]
+    record_counters_dict: dict = stats_dict["record_counters"]     #keys: bucket keys, values: number of read-pairs in that bucket
+    sum_of_reads: int = sum(list(record_counters_dict.values()))
+    percent_of_reads: float = 0
+    ci_list: list = []          #[lower bound, upper bound] of the 95% confidence interval of the current bucket's fraction
+    ci_errors_list: list = [[], []]     #distances from each bucket's percentage down/up to its confidence interval bounds, for the plot's error bars
+
+    #write counts and percentages of each bucket (and confidence intervals, for samples) to output TSV file
+    with open(report_filenames_list[0], "w") as output_stats_fh:
+        if stats_dict["report_type"] == "sample":
+            output_stats_fh.write("Bucket\tNumber_of_Read_Pairs\tPercentage_of_Reads\tLower_95_CI\tUpper_95_CI\n")
+        else:
+            output_stats_fh.write("Bucket" + "\t" + "Number_of_Read_Pairs" + "\t" + "Percentage_of_Reads" + "\n")
+        for bucket in record_counters_dict:
+            percent_of_reads = (record_counters_dict[bucket] / max(sum_of_reads, 1)) * 100
+            if stats_dict["report_type"] == "sample":
+                ci_list = get_wilson_interval(record_counters_dict[bucket], sum_of_reads)
+                ci_errors_list[0].append(percent_of_reads - ci_list[0] * 100)
+                ci_errors_list[1].append(ci_list[1] * 100 - percent_of_reads)
+                output_stats_fh.write(bucket + "\t" + str(record_counters_dict[bucket]) + "\t" + str(percent_of_reads) + "\t" + str(ci_list[0] * 100) + "\t" + str(ci_list[1] * 100) + "\n")
+            else:
+                output_stats_fh.write(bucket + "\t" + str(record_counters_dict[bucket]) + "\t" + str(percent_of_reads) + "\n")
+        if stats_dict["report_type"] == "sample":
+            output_stats_fh.write("\nSampled_read_pairs:\t" + str(sum_of_reads) + "\nSample_method:\t" + stats_dict["sample_method"] + "\n")
+        else:
+            output_stats_fh.write("\nTotal_read_pairs:\t" + str(sum_of_reads) + "\n")
+
+    write_index_pair_matrix(stats_dict["index_pair_matrix"], stats_dict["index_pair_labels"], report_filenames_list[2])
+
+    if plot:
+        plot_bucket_counts(report_filenames_list[1], record_counters_dict, ci_errors_list if stats_dict["report_type"] == "sample" else None, stats_dict.get("sample_method", ""))
+
+def get_lanes(manifest_file: str) -> list:
+    '''Takes a tab-separated manifest file of lanes (header line, then 1 line per lane: lane name, read1 file, read2 file, index1 file, index2 file; blank lines and lines starting with "#" are skipped).
+    Returns a list of dictionaries, 1 per lane, with keys: "name", "read1", "read2", "index1", "index2" (absolute filenames). Raises a ValueError if a line doesn't have 5 columns or a lane name is used twice.'''
+    # local variables
+    lanes_list: list = []
+    lane_names_set: set = set()
+    fields_list: list = []
+
+    with open(manifest_file, "r") as manifest_fh:
+        manifest_fh.readline()  #skip header line
+        for line in manifest_fh:
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            fields_list = line.rstrip("\n").split("\t")
+            if len(fields_list) != 5:
+                raise ValueError("Manifest line doesn't have 5 tab-separated columns (lane name, read1, read2, index1, index2): " + line.strip())
+            if fields_list[0] in lane_names_set:
+                raise ValueError("Lane name used more than once in manifest: " + fields_list[0])
+            lane_names_set.add(fields_list[0])
+            lanes_list.append({
+                "name": fields_list[0], 
+                "read1": os.path.abspath(fields_list[1]), 
+                "read2": os.path.abspath(fields_list[2]), 
+                "index1": os.path.abspath(fields_list[3]), 
+                "index2": os.path.abspath(fields_list[4])
+                })
+    return lanes_list
+
+def load_lane_results(run_settings_dict: dict) -> dict:
+    '''Reads the results of a finished run (demux_stats.json in the current directory, see write_stats_file) back in. Returns a dictionary in the same form parse_input_files returns, 
+    or None if the run hasn't finished (no stats file yet, or a checkpoint is still there) or if its stats file was written by a run with different settings than run_settings_dict (see get_run_settings).'''
+    # local variables
+    stats_dict: dict = {}
+
+    if not os.path.exists("demux_stats.json") or os.path.exists("demux_checkpoint.json"):
+        return None
+    stats_dict = load_stats_file("demux_stats.json")
+    if stats_dict.get("run_settings") != run_settings_dict:
+        print("demux_stats.json in " + os.getcwd() + " was written by a run with different settings, demultiplexing again", file=sys.stderr)
+        return None
+    return {"record_counters": stats_dict["record_counters"], "index_pair_matrix": stats_dict["index_pair_matrix"]}
+
+def run_lane(lane_dict: dict, lane_dir: str, index_table: dict, ref_indexes_dict: dict, quality_filter: dict, workers: int, batch_size: int, io_options: dict, run_options: dict) -> dict:
+    '''Demultiplexes 1 lane (see get_lanes) with parse_input_files. If lane_dir isn't "", the lane's outputs and reports are written in that directory (it's created if needed, and the process changes into it, so this runs in its own process in batch mode).
+    run_options holds settings for the run around parse_input_files (keys: "metrics_file", "metrics_interval", "profile", "fifo", "stdout_bucket", "sample_size", "sample_method", "sample_seed", "report"); with "fifo" or "stdout_bucket", reads are streamed to named pipes or to stdout (see demux_io) instead of written to files.
+    If "sample_size" > 0, the lane is only sampled (see sample_input_files) instead of demultiplexed.
+    If "report" is True, the reports are rendered from the run's stats file (see write_report) at the end; if that fails (e.g. a broken matplotlib install), the error is printed and the stats file is kept, so the reports can be rendered again later.
+    With --resume, a lane that already finished isn't run again.
+    Returns the parse_input_files (or sample_input_files) result.'''
+    # local variables
+    output_files_dict: dict = {}    #keys: bucket keys, values: list [read1 output file, read2 output file]
+    metrics_fh = sys.stderr     #progress reports go to stderr unless a metrics file is given
+    profiler = None
+    lane_results_dict: dict = {}
+    metrics_filename: str = run_options["metrics_file"]
+    stats_filename: str = "demux_sample_stats.json" if run_options["sample_size"] > 0 else "demux_stats.json"
+
+    if lane_dir != "":
+        os.makedirs(lane_dir, exist_ok=True)
+        os.chdir(lane_dir)
+    output_files_dict = get_output_files_dict(lane_dict["read1"], lane_dict["read2"], ref_indexes_dict, io_options["compress"])
+    if io_options.get("resume", False) and run_options["sample_size"] == 0:
+        lane_results_dict = load_lane_results(get_run_settings(lane_dict["read1"], lane_dict["read2"], lane_dict["index1"], lane_dict["index2"], index_table, output_files_dict, quality_filter, io_options))
+        if lane_results_dict is not None:
+            print("Lane " + lane_dict["name"] + " already finished, using its stats file", file=sys.stderr)
+            return lane_results_dict
+
+    if run_options["sample_size"] > 0:
+        lane_results_dict = sample_input_files(
+            lane_dict["index1"], lane_dict["index2"], index_table, list(output_files_dict.keys()), quality_filter, 
+            run_options["sample_size"], run_options["sample_method"], batch_size, run_options["sample_seed"]
+            )
+        render_lane_report(stats_filename, run_options["report"])
+        return lane_results_dict
+    if run_options["fifo"]:
+        io_options = dict(io_options, bucket_writer=demux_io.FifoBucketWriter(output_files_dict))
+    elif run_options["stdout_bucket"] != "":
+        io_options = dict(io_options, bucket_writer=demux_io.InterleavedBucketWriter(get_bucket_key(run_options["stdout_bucket"], ref_indexes_dict), sys.stdout.buffer))
+    if metrics_filename != "":
+        #lanes run at the same time, so they can't share a metrics file: relative paths already land in the lane's directory, absolute ones get the lane name added
+        if lane_dict["name"] != "" and os.path.isabs(metrics_filename):
+            metrics_filename = os.path.splitext(metrics_filename)[0] + "_" + lane_dict["name"] + os.path.splitext(metrics_filename)[1]
+        metrics_fh = open(metrics_filename, "w")
+    if run_options["profile"]:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        lane_results_dict = parse_input_files(
+            lane_dict["read1"], lane_dict["read2"], lane_dict["index1"], lane_dict["index2"], index_table, output_files_dict, quality_filter, workers, batch_size, io_options, 
+            demux_metrics.RunMetrics(metrics_fh, run_options["metrics_interval"], labels={"lane": lane_dict["name"]} if lane_dict["name"] != "" else None)
+            )
+    except BrokenPipeError:
+        if run_options["stdout_bucket"] == "":
+            raise
+        #the reader of --stdout-bucket output exited early (e.g. demux.py ... | head): stop quietly like other command line tools. stdout is pointed at /dev/null first, so Python's last flush of it doesn't fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(141)
+    if run_options["profile"]:
+        profiler.disable()
+        profiler.dump_stats("demux_profile.prof")
+        with open("demux_profile.txt", "w") as profile_fh:
+            pstats.Stats(profiler, stream=profile_fh).sort_stats("cumulative").print_stats(40)
+    if metrics_filename != "":
+        metrics_fh.close()
+    render_lane_report(stats_filename, run_options["report"])
+    return lane_results_dict
+
+def render_lane_report(stats_filename: str, report: bool):
+    '''Renders the reports of a lane's stats file (see write_report) if report is True. Errors are printed instead of raised, so a run never fails after all its reads were demultiplexed just because a report couldn't be rendered.'''
+    if not report:
+        return
+    try:
+        write_report(stats_filename)
+    except Exception as error:
+        print("Couldn't render the reports of " + os.path.abspath(stats_filename) + " (" + repr(error) + "), the counts are saved in it: run demux.py report " + os.path.abspath(stats_filename) + " to try again", file=sys.stderr)
+
+def write_batch_summary(lanes_list: list, lane_results_list: list, index_table: dict, summary_filename_prefix: str):
+    '''Writes the combined report of a batch run: summary_filename_prefix + "_summary.tsv" (read-pairs in each bucket for each lane, all lanes together, and percentage of all read-pairs)
+    and summary_filename_prefix + "_index_pair_matrix.tsv/.npy" (index pair matrix of all lanes added together, see write_index_pair_matrix).'''
+    # local variables
+    buckets_list: list = list(lane_results_list[0]["record_counters"].keys())
+    bucket_totals_dict: dict = {}   #keys: bucket keys, values: read-pairs in that bucket across all lanes
+    sum_of_reads: int = 0
+
+    for bucket in buckets_list:
+        bucket_totals_dict[bucket] = sum([lane_results_dict["record_counters"][bucket] for lane_results_dict in lane_results_list])
+    sum_of_reads = sum(list(bucket_totals_dict.values()))
+
+    with open(summary_filename_prefix + "_summary.tsv", "w") as summary_fh:
+        summary_fh.write("Bucket\t" + "\t".join([lane_dict["name"] for lane_dict in lanes_list]) + "\tAll_Lanes\tPercentage_of_Reads\n")
+        for bucket in buckets_list:
+            summary_fh.write(
+                bucket + "\t" + "\t".join([str(lane_results_dict["record_counters"][bucket]) for lane_results_dict in lane_results_list]) + "\t" 
+                + str(bucket_totals_dict[bucket]) + "\t" + str(bucket_totals_dict[bucket] / max(sum_of_reads, 1) * 100) + "\n"
+                )
+        summary_fh.write(
+            "\nTotal_read_pairs:\t" + "\t".join([str(sum(list(lane_results_dict["record_counters"].values()))) for lane_results_dict in lane_results_list]) + "\t" + str(sum_of_reads) + "\n"
+            )
+
+    write_index_pair_matrix(sum([lane_results_dict["index_pair_matrix"] for lane_results_dict in lane_results_list]), get_index_pair_labels(index_table), summary_filename_prefix + "_index_pair_matrix")
+
+def run_lanes(lanes_list: list, index_table: dict, ref_indexes_dict: dict, quality_filter: dict, cpu_budget: int, lanes_at_once: int, batch_size: int, io_options: dict, run_options: dict) -> list:
+    '''Demultiplexes every lane in lanes_list (see get_lanes), each in its own process and output directory, with lanes_at_once lanes running at a time (0: as many as cpu_budget allows).
+    The cpu_budget is split evenly between the lanes running at the same time (at least 1 worker each). Lanes with the biggest input files are started first, so a big lane doesn't end up running alone at the end.
+    Returns a list of the run_lane result of each lane, in lanes_list order.'''
+    # local variables
+    workers_per_lane: int = 1
+    lane_futures_dict: dict = {}    #keys: lane names, values: futures of run_lane results
+    start_dir: str = os.getcwd()
+
+    if lanes_at_once <= 0:
+        lanes_at_once = cpu_budget
+    lanes_at_once = max(1, min(lanes_at_once, len(lanes_list)))
+    workers_per_lane = max(1, cpu_budget // lanes_at_once)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=lanes_at_once) as executor:
+        for lane_dict in sorted(lanes_list, key=lambda lane_dict: sum([os.path.getsize(lane_dict[key]) for key in ["read1", "read2", "index1", "index2"]]), reverse=True):
+            lane_futures_dict[lane_dict["name"]] = executor.submit(
+                run_lane, lane_dict, os.path.join(start_dir, lane_dict["name"]), index_table, ref_indexes_dict, quality_filter, workers_per_lane, batch_size, io_options, run_options
+                )
+        return [lane_futures_dict[lane_dict["name"]].result() for lane_dict in lanes_list]
+
+def exit_on_sigterm(signum, frame):
+    '''SIGTERM handler: exits through SystemExit like Ctrl-C does through KeyboardInterrupt, so a run killed by kill or a job scheduler still removes its named pipes (see parse_input_files)'''
+    sys.exit(128 + signum)
 
 def main():
     '''Main function, drives the order of execution for script'''
     #local variables
     args = get_args()
-    readfile_list: list = args.r
-    indexfile_list: list = args.i
     ref_indexes_file: str = args.t
-    qscore_cutoff: int = args.q
+    quality_filter: dict = {"cutoff": args.q, "policy": args.qscore_policy, "max_low_bases": args.max_low_bases}    #settings for index qscore check (see get_low_quality_flags)
+    max_mismatches: int = args.max_mismatches
+    workers: int = args.workers
+    batch_size: int = args.batch_size
+    io_options: dict = {    #input/output settings (see parse_input_files)
+        "decompress_command": args.decompressor, 
+        "prefetch_chunks": args.prefetch_chunks, 
+        "compress": args.compress, 
+        "compress_level": args.compress_level, 
+        "compress_threads": args.compress_threads, 
+        "buffer_bytes": args.buffer_size_mb * 1048576, 
+        "max_open_files": args.max_open_files, 
+        "checkpoint_records": args.checkpoint_every, 
+        "resume": args.resume, 
+        "record_range": args.record_range
+        }
+    run_options: dict = {   #settings for the run around parse_input_files (see run_lane)
+        "metrics_file": args.metrics_file, 
+        "metrics_interval": args.metrics_interval, 
+        "profile": args.profile, 
+        "fifo": args.fifo, 
+        "stdout_bucket": args.stdout_bucket, 
+        "sample_size": args.sample, 
+        "sample_method": args.sample_method, 
+        "sample_seed": args.sample_seed, 
+        "report": not args.no_report
+        }
+    lanes_list: list = []           #list of lane dictionaries (see get_lanes)
+    lane_results_list: list = []
     ref_indexes_dict: dict = {}     #keys: reference index sequences, values: reference index names
-    output_files_dict: dict = {}    #keys: name of output FASTQ files, values: number of FASTQ records in file
+    index_table: dict = {}          #lookup table used to classify each read-pair (see get_index_table)
+
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
 
+    #the index table is built once and shared by every lane
     ref_indexes_dict = get_ref_indexes(ref_indexes_file)
-    #print(ref_indexes_dict)
-    output_files_dict = get_output_files_dict(readfile_list[0], readfile_list[1], ref_indexes_dict)
-    #print(output_files_dict)
-    #print(len(list(output_files_dict.keys())))
-    parse_input_files(readfile_list[0], readfile_list[1], indexfile_list[0], indexfile_list[1], ref_indexes_dict, output_files_dict, qscore_cutoff)
+    index_table = get_index_table(ref_indexes_dict, max_mismatches)
+
+    if args.manifest == "":
+        #single lane, outputs go in the current directory
+        run_lane({"name": "", "read1": args.r[0], "read2": args.r[1], "index1": args.i[0], "index2": args.i[1]}, "", index_table, ref_indexes_dict, quality_filter, workers, batch_size, io_options, run_options)
+    else:
+        lanes_list = get_lanes(args.manifest)
+        lane_results_list = run_lanes(lanes_list, index_table, ref_indexes_dict, quality_filter, workers, args.lanes_at_once, batch_size, io_options, run_options)
+        write_batch_summary(lanes_list, lane_results_list, index_table, "demux_batch_sample" if args.sample > 0 else "demux_batch")
+
+
+def get_report_args():
+    '''Defines/sets possible command line arguments for the report stage (demux.py report ...)'''
+    parser = argparse.ArgumentParser("demux.py report", description="Renders the reports (bucket report TSV, bucket plot PNG, index pair matrix TSV/.npy) of finished runs from their stats files, e.g. after --no-report or for many lanes at once, without reading any FASTQ files. Reports are written next to each stats file.")
+    parser.add_argument("stats_files", nargs="+", help="Specifies stats file(s) written by demux.py (demux_stats.json, or demux_sample_stats.json for --sample runs).", type=str)
+    parser.add_argument("--no-plot", help="Only write the TSV/.npy reports, not the plots.", action="store_true")
+    return parser.parse_args(sys.argv[2:])
+
+def report_main():
+    '''Main function of the report stage, renders the reports of each given stats file'''
+    #local variables
+    args = get_report_args()
+
+    for stats_filename in args.stats_files:
+        write_report(stats_filename, not args.no_plot)
 
 
 if __name__ == "__main__":
-    main()
-    
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "report":
+        report_main()
+    else:
+        main()
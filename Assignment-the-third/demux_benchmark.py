@@ -0,0 +1,321 @@
+#!/bin/python
+'''Synthetic FASTQ generator and throughput benchmarks for demux.py and read_qscores.py.
+
+    python demux_benchmark.py generate -o bench_data -n 1000000
+    python demux_benchmark.py run -d bench_data -o results.json [--baseline old_results.json]
+'''
+import argparse
+import gzip     #needed to write gzipped synthetic FASTQ files
+import json     #needed to write machine-readable benchmark results
+import os
+import resource     #needed to measure CPU time of this process and of the worker processes
+import subprocess   #needed to run read_qscores.py, which lives in Assignment-the-first
+import sys
+import tempfile     #needed for scratch directories that benchmark output gets written to
+import time
+import numpy as np  #needed to generate whole batches of synthetic reads at once
+import demux
+import demux_io
+
+READ_QSCORES_SCRIPT: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Assignment-the-first", "read_qscores.py")
+
+#the 24 reference indexes from indexes.txt on Talapas; --num-indexes beyond 24 get random indexes added
+DEFAULT_INDEXES: list = [
+    ("B1", "GTAGCGTA"), ("A5", "CGATCGAT"), ("C1", "GATCAAGG"), ("B9", "AACAGCGA"), ("C9", "TAGCCATG"), ("C3", "CGGTAATC"),
+    ("B3", "CTCTGGAT"), ("C4", "TACCGGAT"), ("A11", "CTAGCTCA"), ("C7", "CACTTCAC"), ("B2", "GCTACTCT"), ("A1", "ACGATCAG"),
+    ("B7", "TATGGCAC"), ("A3", "TGTTCCGT"), ("B4", "GTCCTAAG"), ("A12", "TCGACAAG"), ("C10", "TCTTCGAC"), ("A2", "ATCATGCG"),
+    ("C2", "ATCGTGGT"), ("A10", "TCGAGAGT"), ("B8", "TCGGATTC"), ("A7", "GATCTTGC"), ("B10", "AGAGTCCA"), ("A8", "AGGATAGC")
+    ]
+
+#qscore profiles: keys: profile names, values: list of (qscore, probability) that each base gets
+QUALITY_PROFILES: dict = {
+    "high": [(41, 0.90), (37, 0.06), (32, 0.025), (25, 0.01), (2, 0.005)],
+    "mixed": [(41, 0.70), (37, 0.12), (32, 0.08), (25, 0.05), (12, 0.03), (2, 0.02)],
+    "low": [(41, 0.40), (37, 0.15), (32, 0.15), (25, 0.12), (12, 0.10), (2, 0.08)]
+    }
+
+BASES: bytes = b"ACGT"
+COMPLEMENT: bytes = bytes.maketrans(b"ACGTN", b"TGCAN")
+
+def get_args():
+    '''Defines/sets possible command line arguments for script'''
+    parser = argparse.ArgumentParser("A program to generate synthetic FASTQ data and benchmark demultiplexing throughput")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="write synthetic R1/R2/I1/I2 FASTQ files and a matching indexes.txt")
+    generate_parser.add_argument("-o", help="specifies output directory", type=str, required=True)
+    generate_parser.add_argument("-n", help="specifies number of read-pairs (default=1000000)", type=int, default=1000000)
+    generate_parser.add_argument("-l", help="specifies biological read length (default=101)", type=int, default=101)
+    generate_parser.add_argument("--num-indexes", help="specifies number of reference indexes (default=24)", type=int, default=24)
+    generate_parser.add_argument("--hop-rate", help="specifies fraction of read-pairs whose index2 comes from a different sample (default=0.001)", type=float, default=0.001)
+    generate_parser.add_argument("--unknown-rate", help="specifies fraction of read-pairs with a random (unknown) index1 (default=0.02)", type=float, default=0.02)
+    generate_parser.add_argument("--n-rate", help="specifies fraction of bases called N (qscore 2) in every read (default=0.005)", type=float, default=0.005)
+    generate_parser.add_argument("--quality-profile", help="specifies qscore distribution of the bases (default=high)", choices=list(QUALITY_PROFILES.keys()), default="high")
+    generate_parser.add_argument("--seed", help="specifies random seed; the same arguments and seed always give the same files (default=1)", type=int, default=1)
+    generate_parser.add_argument("--compress-level", help="specifies gzip compression level of the generated files (default=1)", type=int, default=1)
+
+    run_parser = subparsers.add_parser("run", help="run micro-benchmarks and end-to-end demultiplexing on generated data")
+    run_parser.add_argument("-d", help="specifies directory of generated data (see generate)", type=str, required=True)
+    run_parser.add_argument("-o", help="specifies JSON results file (default: print to stdout)", type=str, default="")
+    run_parser.add_argument("-w", nargs="+", help="specifies number(s) of worker processes for the end-to-end benchmark, e.g. -w 1 2 4 8 to see how it scales. The first is reported as end_to_end, others as end_to_end_w<number> (default=1)", type=int, default=[1])
+    run_parser.add_argument("--decompressor", help="specifies external decompressor command for the end-to-end benchmark, as in demux.py --decompressor (default: Python's zlib, on threads of the main process)", type=str, default="")
+    run_parser.add_argument("--repeats", help="specifies number of times each benchmark is run; the fastest run is reported (default=3)", type=int, default=3)
+    run_parser.add_argument("--baseline", help="specifies a results file from an earlier run to compare against", type=str, default="")
+    run_parser.add_argument("--tolerance", help="specifies fraction by which a rate can drop below the baseline before it counts as a regression (default=0.1)", type=float, default=0.1)
+    return parser.parse_args()
+
+def get_synthetic_indexes(num_indexes: int, rng: np.random.Generator) -> list:
+    '''Returns a list of (index name, index sequence) tuples: the Talapas indexes first, then random 8 bp indexes (no repeats) if more are needed.'''
+    # local variables
+    indexes_list: list = DEFAULT_INDEXES[:num_indexes]
+    index_seqs_set: set = set([index_seq for index_name, index_seq in indexes_list])
+    index_seq: str = ""
+
+    while len(indexes_list) < num_indexes:
+        index_seq = bytes([BASES[base] for base in rng.integers(0, 4, 8)]).decode("ascii")
+        if index_seq not in index_seqs_set:
+            index_seqs_set.add(index_seq)
+            indexes_list.append(("S" + str(len(indexes_list) + 1), index_seq))
+    return indexes_list
+
+def get_random_bases(rng: np.random.Generator, num_reads: int, read_len: int, n_rate: float) -> np.ndarray:
+    '''Returns a 2D uint8 array (rows: reads, cols: positions) of random base characters, with about n_rate of them set to N.'''
+    # local variables
+    base_matrix: np.ndarray = np.frombuffer(BASES, dtype=np.uint8)[rng.integers(0, 4, (num_reads, read_len))]
+
+    base_matrix[rng.random((num_reads, read_len)) < n_rate] = ord("N")
+    return base_matrix
+
+def get_random_quals(rng: np.random.Generator, base_matrix: np.ndarray, quality_profile: str) -> np.ndarray:
+    '''Returns a 2D uint8 array of phred+33 characters with qscores drawn from a quality profile (see QUALITY_PROFILES). N bases always get qscore 2 ("#").'''
+    # local variables
+    qscores: np.ndarray = np.array([qscore for qscore, probability in QUALITY_PROFILES[quality_profile]], dtype=np.uint8)
+    probabilities: np.ndarray = np.array([probability for qscore, probability in QUALITY_PROFILES[quality_profile]])
+    qual_matrix: np.ndarray = qscores[rng.choice(len(qscores), size=base_matrix.shape, p=probabilities / probabilities.sum())] + 33
+
+    qual_matrix[base_matrix == ord("N")] = 2 + 33
+    return qual_matrix
+
+def write_fastq_batch(fh, headers_list: list, read_num: int, base_matrix: np.ndarray, qual_matrix: np.ndarray):
+    '''Writes one FASTQ record per row of base_matrix/qual_matrix to an open file, with Illumina-style headers for the given read number (1-4).'''
+    # local variables
+    suffix: bytes = b" " + str(read_num).encode("ascii") + b":N:0:1"
+    lines_list: list = []
+
+    for header, seq, qual in zip(headers_list, base_matrix, qual_matrix):
+        lines_list.extend([header + suffix, seq.tobytes(), b"+", qual.tobytes()])
+    fh.write(b"\n".join(lines_list) + b"\n")
+
+def generate_data(output_dir: str, num_reads: int, read_len: int, num_indexes: int, hop_rate: float, unknown_rate: float, n_rate: float, quality_profile: str, seed: int, compress_level: int = 1):
+    '''Writes synchronized synthetic R1/R2/I1/I2 gzipped FASTQ files (R1.fq.gz, R4.fq.gz: biological reads, R2.fq.gz, R3.fq.gz: index1 and reverse-complemented index2 reads) and a matching indexes.txt to output_dir.
+    The same arguments always give the same files.'''
+    # local variables
+    rng: np.random.Generator = np.random.default_rng(seed)
+    indexes_list: list = get_synthetic_indexes(num_indexes, rng)
+    index_matrix: np.ndarray = np.array([np.frombuffer(index_seq.encode("ascii"), dtype=np.uint8) for index_name, index_seq in indexes_list])
+    batch_size: int = 100000
+    batch_start: int = 0
+    batch_len: int = 0
+    sample_ids: np.ndarray = None
+    index2_sample_ids: np.ndarray = None
+    index1_matrix: np.ndarray = None
+    index2_matrix: np.ndarray = None
+    unknown_mask: np.ndarray = None     #True for each read-pair that gets a random unknown index1
+    headers_list: list = []
+    fh_list: list = []
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "indexes.txt"), "w") as indexes_fh:
+        indexes_fh.write("sample\tgroup\ttreatment\tindex\tindex sequence\n")
+        for sample_num, (index_name, index_seq) in enumerate(indexes_list):
+            indexes_fh.write(str(sample_num + 1) + "\t1A\tcontrol\t" + index_name + "\t" + index_seq + "\n")
+
+    #mtime=0 keeps the timestamp out of the gzip headers, so the files are identical from run to run
+    fh_list = [gzip.GzipFile(os.path.join(output_dir, "R" + str(read_num) + ".fq.gz"), "wb", compress_level, mtime=0) for read_num in range(1, 5)]
+    for batch_start in range(0, num_reads, batch_size):
+        batch_len = min(batch_size, num_reads - batch_start)
+        headers_list = [b"@SYNTH:1:FLOWCELL:1:1101:" + str(read_num).encode("ascii") + b":1000" for read_num in range(batch_start, batch_start + batch_len)]
+
+        #each read-pair comes from one sample; some get a hopped index2 from another sample, or a random unknown index1
+        sample_ids = rng.integers(0, num_indexes, batch_len)
+        #a hopped index2 comes from one of the other samples: adding 1 to num_indexes - 1 (mod num_indexes) never gives the read-pair's own sample
+        index2_sample_ids = np.where(rng.random(batch_len) < hop_rate, (sample_ids + rng.integers(1, max(num_indexes, 2), batch_len)) % num_indexes, sample_ids)
+        index1_matrix = index_matrix[sample_ids]
+        unknown_mask = rng.random(batch_len) < unknown_rate
+        index1_matrix[unknown_mask] = np.frombuffer(BASES, dtype=np.uint8)[rng.integers(0, 4, (unknown_mask.sum(), index_matrix.shape[1]))]   #a different random sequence for each unknown index1
+        index2_matrix = np.frombuffer(index_matrix[index2_sample_ids][:, ::-1].tobytes().translate(COMPLEMENT), dtype=np.uint8).reshape(batch_len, -1).copy()
+        for matrix in [index1_matrix, index2_matrix]:
+            matrix[rng.random(matrix.shape) < n_rate] = ord("N")
+
+        for read_num, fh, base_matrix in [(1, fh_list[0], get_random_bases(rng, batch_len, read_len, n_rate)), (4, fh_list[3], get_random_bases(rng, batch_len, read_len, n_rate)), (2, fh_list[1], index1_matrix), (3, fh_list[2], index2_matrix)]:
+            write_fastq_batch(fh, headers_list, read_num, base_matrix, get_random_quals(rng, base_matrix, quality_profile))
+    for fh in fh_list:
+        fh.close()
+
+def time_benchmark(function, repeats: int) -> float:
+    '''Runs a function repeats times and returns the fastest run time in seconds.'''
+    # local variables
+    fastest_time: float = float("inf")
+    start_time: float = 0
+
+    for repeat in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        fastest_time = min(fastest_time, time.perf_counter() - start_time)
+    return fastest_time
+
+def get_cpu_seconds() -> list:
+    '''Returns a list [CPU seconds used by this process (all threads), CPU seconds used by its finished child processes].'''
+    # local variables
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return [self_usage.ru_utime + self_usage.ru_stime, children_usage.ru_utime + children_usage.ru_stime]
+
+def run_benchmarks(data_dir: str, workers_list: list, repeats: int, decompress_command: str = "") -> dict:
+    '''Runs micro-benchmarks of the demultiplexing hot path plus an end-to-end demultiplexing run with each number of workers in workers_list (and the external decompressor decompress_command, if given) on generated data (see generate_data).
+    Returns a dictionary with keys: benchmark names, values: dictionary of "seconds" and rates (items/sec).'''
+    # local variables
+    input_files_list: list = [os.path.abspath(os.path.join(data_dir, "R" + str(read_num) + ".fq.gz")) for read_num in [1, 4, 2, 3]]    #R1, R2 (biological), I1, I2 (index), in the order demux.py uses
+    ref_indexes_dict: dict = demux.get_ref_indexes(os.path.join(data_dir, "indexes.txt"))
+    index_table: dict = demux.get_index_table(ref_indexes_dict)
+    quality_filter: dict = {"cutoff": 30, "policy": "min", "max_low_bases": 0}
+    blocks_list: list = []
+    num_records: int = 0
+    input_bytes: int = 0
+    batch_output_list: list = []
+    index_seqs: list = []
+    index_quals: list = []
+    results_dict: dict = {}
+    seconds: float = 0
+    start_cpu_seconds: list = []    #[this process, child processes] CPU seconds before the end-to-end runs with one number of workers (see get_cpu_seconds)
+    main_cpu_seconds: float = 0
+    workers_cpu_seconds: float = 0
+
+    #load all records once, so the micro-benchmarks below don't include decompression
+    with demux_io.PrefetchReader(input_files_list[0]) as fh0, demux_io.PrefetchReader(input_files_list[1]) as fh1, demux_io.PrefetchReader(input_files_list[2]) as fh2, demux_io.PrefetchReader(input_files_list[3]) as fh3:
+        blocks_list = list(demux.get_record_blocks([fh0, fh1, fh2, fh3], 10000))
+    num_records = sum([len(block[0]) // 4 for block in blocks_list])
+    for input_file in input_files_list:
+        with gzip.open(input_file, "rb") as fh:
+            input_bytes += len(fh.read())
+    index_seqs = [seq.decode("ascii") for block in blocks_list for seq in block[3][1::4]]
+    index_quals = [qual for block in blocks_list for qual in block[2][3::4]]
+
+    #reading/splitting records out of the 4 gzipped input files
+    def read_blocks():
+        fh_list = [demux_io.PrefetchReader(input_file) for input_file in input_files_list]
+        for block in demux.get_record_blocks(fh_list, 10000):
+            pass
+        for fh in fh_list:
+            fh.close()
+    seconds = time_benchmark(read_blocks, repeats)
+    results_dict["read_record_blocks"] = {"seconds": seconds, "records_per_sec": num_records / seconds, "bytes_per_sec": input_bytes / seconds}
+
+    #per-character reverse complement of index2 reads (only used when building the index table now)
+    seconds = time_benchmark(lambda: [demux.rev_comp(seq) for seq in index_seqs], repeats)
+    results_dict["rev_comp"] = {"seconds": seconds, "records_per_sec": num_records / seconds}
+
+    #old per-character convert_phred quality check vs. the batched check
+    def convert_phred_filter():
+        for qual in index_quals:
+            for char in qual.decode("ascii"):
+                if demux.convert_phred(char) < quality_filter["cutoff"]:
+                    break
+    seconds = time_benchmark(convert_phred_filter, repeats)
+    results_dict["convert_phred_filter"] = {"seconds": seconds, "records_per_sec": num_records / seconds}
+    seconds = time_benchmark(lambda: [demux.get_low_quality_flags(block[2][3::4], quality_filter) for block in blocks_list], repeats)
+    results_dict["batch_quality_filter"] = {"seconds": seconds, "records_per_sec": num_records / seconds}
+
+    #classification and formatting of output records
+    seconds = time_benchmark(lambda: [demux.demultiplex_batch(block, index_table, quality_filter) for block in blocks_list], repeats)
+    results_dict["demultiplex_batch"] = {"seconds": seconds, "records_per_sec": num_records / seconds}
+
+    #buffered writing of the bucket files
+    batch_output_list = [demux.demultiplex_batch(block, index_table, quality_filter) for block in blocks_list]
+    def write_buckets():
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_files_dict = {bucket: [os.path.join(temp_dir, bucket + "_R1.fq"), os.path.join(temp_dir, bucket + "_R2.fq")] for bucket in list(ref_indexes_dict.keys()) + ["swapped", "unknown_lowQ"]}
+            with demux_io.BucketWriter(output_files_dict) as bucket_writer:
+                for batch_output_dict, index_pair_counts in batch_output_list:
+                    for bucket in batch_output_dict:
+                        bucket_writer.write(bucket, batch_output_dict[bucket][0], batch_output_dict[bucket][1])
+    seconds = time_benchmark(write_buckets, repeats)
+    results_dict["bucket_writer"] = {"seconds": seconds, "records_per_sec": num_records / seconds}
+
+    #read_qscores.py run on the read1 file, as a script (it belongs to another assignment, so it isn't imported). Includes Python startup; --no-report leaves out the plot
+    def read_qscores_run():
+        with tempfile.TemporaryDirectory() as temp_dir:
+            subprocess.run([sys.executable, READ_QSCORES_SCRIPT, "-f", input_files_list[0], "-o", "bench", "--no-report"], cwd=temp_dir, check=True)
+    seconds = time_benchmark(read_qscores_run, repeats)
+    results_dict["read_qscores_run"] = {"seconds": seconds, "records_per_sec": num_records / seconds}
+
+    #whole demultiplexing run, from gzipped inputs to bucket files and the stats file. Like a --no-report run, the reports (demux.py report) aren't rendered, so matplotlib isn't timed.
+    #CPU time is split into this process (reading, decompression threads, and with 1 worker everything else) and its child processes (workers, external decompressors): more workers can't spread out this process's share,
+    #so max_speedup = total / this process's share is the most adding workers can gain, which can be measured even on a machine with fewer CPUs than workers
+    for workers in workers_list:
+        def demultiplex_all():
+            start_dir = os.getcwd()
+            with tempfile.TemporaryDirectory() as temp_dir:
+                os.chdir(temp_dir)
+                try:
+                    output_files_dict = demux.get_output_files_dict(input_files_list[0], input_files_list[1], ref_indexes_dict)
+                    demux.parse_input_files(input_files_list[0], input_files_list[1], input_files_list[2], input_files_list[3], index_table, output_files_dict, quality_filter, workers, io_options={"checkpoint_records": 0, "decompress_command": decompress_command})
+                finally:
+                    os.chdir(start_dir)
+        start_cpu_seconds = get_cpu_seconds()
+        seconds = time_benchmark(demultiplex_all, repeats)
+        main_cpu_seconds = (get_cpu_seconds()[0] - start_cpu_seconds[0]) / repeats
+        workers_cpu_seconds = (get_cpu_seconds()[1] - start_cpu_seconds[1]) / repeats
+        results_dict["end_to_end" if workers == workers_list[0] else "end_to_end_w" + str(workers)] = {
+            "seconds": seconds, "records_per_sec": num_records / seconds, "bytes_per_sec": input_bytes / seconds, "workers": workers, 
+            "main_cpu_seconds": main_cpu_seconds, "workers_cpu_seconds": workers_cpu_seconds, "max_speedup": (main_cpu_seconds + workers_cpu_seconds) / main_cpu_seconds
+            }
+
+    return {"num_records": num_records, "input_bytes": input_bytes, "benchmarks": results_dict}
+
+def find_regressions(results_dict: dict, baseline_dict: dict, tolerance: float) -> list:
+    '''Compares benchmark results against an earlier results file and returns a list of messages, one for each rate that dropped by more than the tolerance (fraction).'''
+    # local variables
+    regressions_list: list = []
+
+    for benchmark_name, benchmark_dict in results_dict["benchmarks"].items():
+        if benchmark_name not in baseline_dict["benchmarks"]:
+            continue
+        for rate_name in ["records_per_sec", "bytes_per_sec"]:
+            if rate_name in benchmark_dict and rate_name in baseline_dict["benchmarks"][benchmark_name]:
+                if benchmark_dict[rate_name] < (1 - tolerance) * baseline_dict["benchmarks"][benchmark_name][rate_name]:
+                    regressions_list.append(benchmark_name + " " + rate_name + ": " + str(round(benchmark_dict[rate_name])) + " (baseline: " + str(round(baseline_dict["benchmarks"][benchmark_name][rate_name])) + ")")
+    return regressions_list
+
+def main():
+    '''Main function, drives the order of execution for script'''
+    # local variables
+    args = get_args()
+    results_dict: dict = {}
+    baseline_dict: dict = {}
+    regressions_list: list = []
+
+    if args.command == "generate":
+        generate_data(args.o, args.n, args.l, args.num_indexes, args.hop_rate, args.unknown_rate, args.n_rate, args.quality_profile, args.seed, args.compress_level)
+        return
+
+    results_dict = run_benchmarks(args.d, args.w, args.repeats, args.decompressor)
+    if args.o != "":
+        with open(args.o, "w") as results_fh:
+            json.dump(results_dict, results_fh, indent=1)
+    else:
+        json.dump(results_dict, sys.stdout, indent=1)
+        print()
+
+    if args.baseline != "":
+        with open(args.baseline, "r") as baseline_fh:
+            baseline_dict = json.load(baseline_fh)
+        regressions_list = find_regressions(results_dict, baseline_dict, args.tolerance)
+        for regression in regressions_list:
+            print("REGRESSION:", regression, file=sys.stderr)
+        if len(regressions_list) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
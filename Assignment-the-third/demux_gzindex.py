@@ -0,0 +1,125 @@
+#!/bin/python
+'''Seekable gzip indexes for FASTQ files: builds a sidecar seek-point index for each gzipped FASTQ file in one pass, so demux.py and read_qscores.py can start reading at any record instead of decompressing the file from the beginning.
+The sidecar for file.fq.gz is 2 files: file.fq.gz.gzidx (zlib window checkpoints, written by the indexed_gzip package) and file.fq.gz.gzidx.json (the uncompressed byte offset of every records_per_point-th record).
+Jobs can then each process their own record range of the same lane, e.g. on separate SLURM nodes.
+Assignment-the-first/Bioinfo.py has its own copy of load_seek_index/open_at_record for read_qscores.py, so a change to the sidecar files has to be made there too.'''
+import argparse
+import concurrent.futures   #needed to index several input files at the same time
+import gzip         #needed to read gzipped files that have no seek index
+import json         #needed to write/read the record offsets sidecar file
+import os           #needed to check the sidecar files are newer than the file they index
+
+try:
+    import indexed_gzip     #zlib window checkpoints (zran), needed to build and use seek indexes
+except ImportError:
+    indexed_gzip = None
+
+def get_args():
+    '''Defines/sets possible command line arguments for script'''
+    parser = argparse.ArgumentParser("A program to build seek-point indexes of gzipped FASTQ files, so record ranges of each file can be read without decompressing it from the beginning")
+    parser.add_argument("-f", nargs="+", help="specifies gzipped FASTQ filename(s) to index", type=str, required=True)
+    parser.add_argument("--records-per-point", help="specifies number of records between recorded record offsets (default=1000000)", type=int, default=1000000)
+    parser.add_argument("--spacing-mb", help="specifies megabytes of uncompressed data between zlib checkpoints. Each checkpoint stores a 32 KiB window, so smaller spacing means faster seeks but bigger indexes (default=16)", type=int, default=16)
+    parser.add_argument("-p", help="specifies number of files indexed at the same time (default: all of them)", type=int, default=0)
+    return parser.parse_args()
+
+def get_index_filenames(gz_filename: str) -> list:
+    '''Returns a list [zlib checkpoints filename, record offsets filename] of the sidecar files of a gzipped file.'''
+    return [gz_filename + ".gzidx", gz_filename + ".gzidx.json"]
+
+def get_nth_line_end(chunk: bytes, n: int) -> int:
+    '''Returns the position just after the nth "\\n" (counting from 1) in chunk.'''
+    # local variables
+    pos: int = 0
+
+    for _ in range(n):
+        pos = chunk.index(b"\n", pos) + 1
+    return pos
+
+def build_seek_index(gz_filename: str, records_per_point: int = 1000000, spacing: int = 16777216, chunk_size: int = 1048576) -> dict:
+    '''Decompresses a gzipped FASTQ file once, recording a zlib checkpoint every spacing bytes of uncompressed data and the uncompressed byte offset of every records_per_point-th record.
+    Writes both to the file's sidecar files (see get_index_filenames) and returns the record offsets dictionary (keys: "records_per_point", "record_offsets", "num_records", "gz_size").'''
+    # local variables
+    checkpoints_filename, offsets_filename = get_index_filenames(gz_filename)
+    chunk: bytes = b""
+    chunk_start: int = 0        #uncompressed byte offset of the start of the current chunk
+    lines_before_chunk: int = 0 #number of lines before the current chunk
+    chunk_lines: int = 0
+    next_point_line: int = 4 * records_per_point    #line number of the next record whose offset gets recorded
+    record_offsets: list = [0]  #uncompressed byte offset of records 0, records_per_point, 2 * records_per_point, ...
+    offsets_dict: dict = {}
+
+    if indexed_gzip is None:
+        raise ImportError("Building seek indexes needs the indexed_gzip package (pip install indexed_gzip)")
+
+    #buffer_size=chunk_size: the default read-ahead buffer can swallow a small file in one read, which adds no checkpoints
+    with indexed_gzip.IndexedGzipFile(gz_filename, spacing=spacing, buffer_size=chunk_size) as gz_fh:
+        while True:
+            chunk = gz_fh.read(chunk_size)
+            if chunk == b"":
+                break
+            chunk_lines = chunk.count(b"\n")
+            while next_point_line <= lines_before_chunk + chunk_lines:
+                record_offsets.append(chunk_start + get_nth_line_end(chunk, next_point_line - lines_before_chunk))
+                next_point_line += 4 * records_per_point
+            chunk_start += len(chunk)
+            lines_before_chunk += chunk_lines
+        gz_fh.build_full_index()    #only adds the checkpoint at the end of the file, everything before it was indexed while reading
+        gz_fh.export_index(checkpoints_filename)
+
+    if chunk_start > 0 and record_offsets[-1] == chunk_start:
+        record_offsets.pop()    #the file ended exactly at a point, so there's no record at that offset
+    offsets_dict = {
+        "records_per_point": records_per_point,
+        "record_offsets": record_offsets,
+        "num_records": lines_before_chunk // 4,
+        "gz_size": os.path.getsize(gz_filename)
+        }
+    with open(offsets_filename, "w") as offsets_fh:
+        json.dump(offsets_dict, offsets_fh)
+    return offsets_dict
+
+def load_seek_index(gz_filename: str) -> dict:
+    '''Returns the record offsets dictionary of a gzipped file's seek index (see build_seek_index), or None if the file has no seek index,
+    if the index is out of date (the file changed since it was indexed), or if the indexed_gzip package isn't installed.'''
+    # local variables
+    checkpoints_filename, offsets_filename = get_index_filenames(gz_filename)
+    offsets_dict: dict = {}
+
+    if indexed_gzip is None or not os.path.exists(checkpoints_filename) or not os.path.exists(offsets_filename):
+        return None
+    with open(offsets_filename, "r") as offsets_fh:
+        offsets_dict = json.load(offsets_fh)
+    if offsets_dict["gz_size"] != os.path.getsize(gz_filename) or os.path.getmtime(offsets_filename) < os.path.getmtime(gz_filename):
+        return None
+    return offsets_dict
+
+def open_at_record(gz_filename: str, record_num: int) -> list:
+    '''Opens a gzipped FASTQ file for binary reading, starting as close to record record_num (counting from 0) as its seek index allows.
+    Returns a list [file object, number of the record the file object starts at]; the caller still has to skip the records between that one and record_num.
+    Files without a (current) seek index are opened at the beginning, i.e. at record 0.'''
+    # local variables
+    offsets_dict: dict = load_seek_index(gz_filename)
+    point_num: int = 0      #index in record_offsets of the last recorded record at or before record_num
+    gz_fh = None
+
+    if record_num <= 0 or offsets_dict is None:
+        return [gzip.open(gz_filename, "rb"), 0]
+    point_num = min(record_num // offsets_dict["records_per_point"], len(offsets_dict["record_offsets"]) - 1)
+    gz_fh = indexed_gzip.IndexedGzipFile(gz_filename, index_file=get_index_filenames(gz_filename)[0])
+    gz_fh.seek(offsets_dict["record_offsets"][point_num])
+    return [gz_fh, point_num * offsets_dict["records_per_point"]]
+
+def main():
+    '''Main function, drives the order of execution for script'''
+    # local variables
+    args = get_args()
+    num_processes: int = args.p if args.p > 0 else len(args.f)
+
+    #index all input files at the same time, each in its own process
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for gz_filename, offsets_dict in zip(args.f, executor.map(build_seek_index, args.f, [args.records_per_point] * len(args.f), [args.spacing_mb * 1048576] * len(args.f))):
+            print(gz_filename + ":", offsets_dict["num_records"], "records,", len(offsets_dict["record_offsets"]), "record offsets")
+
+if __name__ == "__main__":
+    main()
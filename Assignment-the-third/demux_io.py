@@ -0,0 +1,497 @@
+#!/bin/python
+'''Input/output helpers for demux.py: threaded prefetching decompression of the gzipped input FASTQ files, and multi-threaded BGZF (blocked gzip) compression of the output FASTQ files, and buffered writing of the output bucket files.
+Output goes through a bucket writer: BucketWriter writes regular files; FifoBucketWriter (named pipes), InterleavedBucketWriter (1 bucket to a stream such as stdout) and CallbackBucketWriter (a function, for library use)
+stream reads to the next tool as they're demultiplexed instead. They all have the same methods: write(bucket, read1 data, read2 data), flush(), get_output_sizes(), close().'''
+import atexit       #needed to remove named pipes (FIFOs) when a run exits early
+import os           #needed to get output file sizes
+import queue        #needed for the bounded queues that pass decompressed chunks between threads
+import resource     #needed to look up the open file limit (ulimit -n)
+import shlex        #needed to split an external decompressor command line into arguments
+import stat         #needed to check whether an existing output file is a named pipe
+import subprocess   #needed to run an external decompressor (e.g. pigz) instead of Python's zlib
+import struct       #needed to pack the binary fields of BGZF block headers/trailers
+import threading    #needed to decompress each input file on its own thread
+import time         #needed to time decompression
+import zlib         #needed to deflate BGZF blocks
+import demux_gzindex    #seek indexes, to start reading an input file at a given record
+from collections import deque, OrderedDict
+
+class PrefetchReader:
+    '''Read-only binary file object for a gzipped file that is decompressed ahead of time on its own thread.
+    The thread reads chunk_size bytes at a time and puts them in a queue holding at most queue_size chunks, so decompression of each input file runs at the same time as
+    classification/writing in the main thread (zlib releases the GIL while decompressing), and memory use is bounded by queue_size * chunk_size per file.
+    If decompress_command is given (e.g. "pigz -dc"), the file is decompressed by that command in a subprocess instead, and the thread only reads the command's stdout.
+    If start_record is given, reading starts at that record (counting from 0): the file is opened at the closest point its seek index allows (see demux_gzindex.open_at_record), and the thread skips the records left before start_record.'''
+
+    def __init__(self, filename: str, decompress_command: str = "", chunk_size: int = 1048576, queue_size: int = 8, start_record: int = 0):
+        self.filename: str = filename
+        self.chunk_size: int = chunk_size
+        self.chunk_queue: queue.Queue = queue.Queue(maxsize=queue_size)     #holds decompressed chunks (bytes), b"" once EOF is reached, or an exception raised by the thread
+        self.buffer: bytes = b""        #holds the part of the most recent chunk that hasn't been returned by read() yet
+        self.is_eof: bool = False
+        self.is_closed: bool = False
+        self.process = None             #subprocess.Popen of the external decompressor, if one is used
+        self.bytes_read: int = 0                #total decompressed bytes returned by read()
+        self.decompress_seconds: float = 0      #total time the prefetch thread spent reading/decompressing
+        self.records_to_skip: int = 0           #records the thread skips before queueing anything (records between the seek point and start_record)
+
+        if decompress_command != "":
+            self.process = subprocess.Popen(shlex.split(decompress_command) + [filename], stdout=subprocess.PIPE)
+            self.source_fh = self.process.stdout
+            self.records_to_skip = start_record     #an external decompressor can only start at the beginning of the file
+        else:
+            self.source_fh, seek_record = demux_gzindex.open_at_record(filename, start_record)
+            self.records_to_skip = start_record - seek_record
+        self.thread = threading.Thread(target=self._fill_queue, name="prefetch " + filename, daemon=True)
+        self.thread.start()
+
+    def _fill_queue(self):
+        '''Runs on the prefetch thread: decompresses the file chunk by chunk into chunk_queue until EOF or close().'''
+        # local variables
+        chunk: bytes = b""
+        start_time: float = 0
+
+        try:
+            chunk = self._skip_records()
+            if chunk != b"":
+                self._put(chunk)
+            while not self.is_closed:
+                start_time = time.perf_counter()
+                chunk = self.source_fh.read(self.chunk_size)
+                self.decompress_seconds += time.perf_counter() - start_time
+                if chunk == b"" and self.process is not None and self.process.wait() != 0:
+                    raise OSError("Decompressor exited with code " + str(self.process.returncode) + " for " + self.filename)
+                self._put(chunk)
+                if chunk == b"":
+                    break
+        except Exception as err:    #hand errors to the reading thread, so they aren't lost on this thread
+            self._put(err)
+
+    def _skip_records(self) -> bytes:
+        '''Runs on the prefetch thread: reads past the first records_to_skip records by counting newlines. Returns whatever was read after the last skipped record.'''
+        # local variables
+        lines_to_skip: int = 4 * self.records_to_skip
+        chunk: bytes = b""
+        newline_pos: int = -1
+        start_time: float = 0
+
+        while lines_to_skip > 0 and not self.is_closed:
+            start_time = time.perf_counter()
+            chunk = self.source_fh.read(self.chunk_size)
+            self.decompress_seconds += time.perf_counter() - start_time
+            if chunk == b"":
+                raise ValueError(self.filename + " has fewer than " + str(self.records_to_skip) + " records to skip")
+            if chunk.count(b"\n") < lines_to_skip:
+                lines_to_skip -= chunk.count(b"\n")
+            else:
+                #the last line to skip ends in this chunk: keep whatever comes after it
+                for line_num in range(lines_to_skip):
+                    newline_pos = chunk.find(b"\n", newline_pos + 1)
+                return chunk[newline_pos + 1:]
+        return b""
+
+    def _put(self, item):
+        '''Puts an item in chunk_queue, giving up if the reader gets closed while the queue is full.'''
+        while not self.is_closed:
+            try:
+                self.chunk_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size: int = -1) -> bytes:
+        '''Returns up to size bytes (or the rest of the current chunk if size < 0) of decompressed data. Like a raw stream, it can return fewer bytes than asked for; it only returns b"" at EOF.'''
+        # local variables
+        data: bytes = b""
+        item = None
+
+        if self.buffer == b"" and not self.is_eof:
+            item = self.chunk_queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if item == b"":
+                self.is_eof = True
+            self.buffer = item
+        if size < 0 or size >= len(self.buffer):
+            data = self.buffer
+            self.buffer = b""
+        else:
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        '''Stops the prefetch thread and closes the file (and the external decompressor, if there is one).'''
+        if self.is_closed:
+            return
+        self.is_closed = True
+        if self.process is not None:
+            if self.process.poll() is None:     #stop the decompressor first, so the thread isn't left waiting on its output
+                self.process.terminate()
+            self.thread.join()
+            self.process.stdout.close()
+            self.process.wait()
+        else:
+            self.thread.join()
+            self.source_fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+#BGZF (blocked gzip) constants, see the SAM/BAM format specification
+BGZF_BLOCK_DATA_SIZE: int = 65280     #max uncompressed bytes per BGZF block (same as htslib), so each compressed block always fits in 64 KiB
+BGZF_HEADER: bytes = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"   #gzip header with the FEXTRA flag and the "BC" subfield; followed by the 2-byte block size
+BGZF_EOF_BLOCK: bytes = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")    #empty block that marks the end of a BGZF file
+
+def compress_bgzf_block(data: bytes, compress_level: int) -> bytes:
+    '''Compresses up to BGZF_BLOCK_DATA_SIZE bytes of data into one complete BGZF block (a gzip member whose header records the size of the block).'''
+    # local variables
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)     #wbits=-15: raw deflate data, the gzip header/trailer get added below
+    compressed_data: bytes = compressor.compress(data) + compressor.flush()
+
+    return (
+        BGZF_HEADER
+        + struct.pack("<H", len(BGZF_HEADER) + 2 + len(compressed_data) + 8 - 1)     #BSIZE: total block size - 1
+        + compressed_data
+        + struct.pack("<II", zlib.crc32(data), len(data))
+        )
+
+class BgzfWriter:
+    '''Binary file object that writes a BGZF file: a series of independent gzip blocks of at most 64 KiB, which any gzip tool can read and tools like htslib/samtools can randomly access.
+    Blocks are compressed on a thread pool (a concurrent.futures executor, which can be shared by many writers) while the calling thread keeps going; zlib releases the GIL while compressing.
+    Compressed blocks are written to the file in order; at most max_pending_blocks blocks per writer are waiting to be compressed/written at any time.'''
+
+    def __init__(self, filename: str, mode: str = "wb", compress_level: int = 6, executor = None, max_pending_blocks: int = 16):
+        self.fh = open(filename, mode)
+        self.compress_level: int = compress_level
+        self.executor = executor    #concurrent.futures executor used to compress blocks, or None to compress on the calling thread
+        self.max_pending_blocks: int = max_pending_blocks
+        self.buffer: bytearray = bytearray()    #holds written data that doesn't fill a whole block yet
+        self.pending_blocks: deque = deque()    #holds futures (or finished blocks if there is no executor) of blocks not yet written to the file, oldest first
+
+    def _submit_block(self, data: bytes):
+        '''Hands one block's worth of data to the executor to be compressed, and writes out finished blocks if too many are pending.'''
+        if self.executor is None:
+            self.pending_blocks.append(compress_bgzf_block(data, self.compress_level))
+        else:
+            self.pending_blocks.append(self.executor.submit(compress_bgzf_block, data, self.compress_level))
+        while len(self.pending_blocks) > self.max_pending_blocks:
+            self._write_oldest_block()
+
+    def _write_oldest_block(self):
+        '''Waits for the oldest pending block to finish compressing and writes it to the file.'''
+        # local variables
+        block = self.pending_blocks.popleft()
+
+        if not isinstance(block, bytes):
+            block = block.result()
+        self.fh.write(block)
+
+    def write(self, data: bytes):
+        '''Adds data to the file. Data is compressed in full blocks; anything left over waits in the buffer for the next write/flush.'''
+        # local variables
+        start: int = 0
+
+        self.buffer += data
+        while len(self.buffer) - start >= BGZF_BLOCK_DATA_SIZE:
+            self._submit_block(bytes(self.buffer[start:start + BGZF_BLOCK_DATA_SIZE]))
+            start += BGZF_BLOCK_DATA_SIZE
+        del self.buffer[:start]
+
+    def flush(self):
+        '''Compresses any buffered data into a (short) block and writes all pending blocks, so the file ends on a block boundary.'''
+        if len(self.buffer) > 0:
+            self._submit_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(self.pending_blocks) > 0:
+            self._write_oldest_block()
+        self.fh.flush()
+
+    def close(self, write_eof: bool = True):
+        '''Flushes the file, writes the BGZF end-of-file marker block (unless write_eof is False, e.g. if more blocks will be appended to the file later), and closes it.'''
+        if self.fh.closed:
+            return
+        self.flush()
+        if write_eof:
+            self.fh.write(BGZF_EOF_BLOCK)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BucketWriter:
+    '''Writes demultiplexed read-pairs to the 2 output files (read1, read2) of each bucket in output_files_dict (keys: bucket keys, values: list [read1 output file, read2 output file]).
+    Data written to each output file is collected in an in-memory buffer. When the buffers of all files together hold more than buffer_bytes, the largest buffers are written out
+    (in one large write each) until the total is back under half of buffer_bytes, so memory use is capped no matter how many buckets there are.
+    At most max_open_files output files are kept open at a time: if there are more output files than that (e.g. 96- or 384-index plates), the least recently written file
+    is closed to make room, and files are reopened in append mode when they get written to again. max_open_files = 0 picks a limit based on the process's open file limit (ulimit -n).
+    If compress is True, output files are written as BGZF files (see BgzfWriter), with blocks compressed on the given executor. Each BgzfWriter is flushed as soon as a buffer has been handed to it, 
+    so compressed blocks waiting to be written and partly filled blocks never pile up in the writers of the open files: buffer_bytes caps all output data held in memory, compressed or not.
+    Compression happens whenever buffers are written out, so with compress=True a flush (e.g. for a checkpoint) also compresses everything still buffered.
+    If append is True, existing output files are added to instead of being emptied (e.g. when resuming from a checkpoint).'''
+
+    def __init__(self, output_files_dict: dict, buffer_bytes: int = 67108864, max_open_files: int = 0, compress: bool = False, compress_level: int = 6, executor = None, append: bool = False):
+        self.output_files_dict: dict = output_files_dict
+        self.buffer_bytes: int = buffer_bytes
+        self.compress: bool = compress
+        self.compress_level: int = compress_level
+        self.executor = executor
+        self.buffers_dict: dict = {}    #keys: output filenames, values: bytearray of data not yet written to that file
+        self.buffered_bytes: int = 0    #total size of all buffers
+        self.open_fh_dict: OrderedDict = OrderedDict()  #keys: output filenames, values: open filehandlers, least recently written first
+        self.is_closed: bool = False
+
+        if max_open_files <= 0:
+            #leave room for the input files, the report files and anything else the process has open
+            max_open_files = max(2, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 64)
+        self.max_open_files: int = max_open_files
+
+        #create (or empty) every output file up front, so every bucket has an output file even if no reads end up in it
+        for bucket in output_files_dict:
+            for output_file in output_files_dict[bucket]:
+                self.buffers_dict[output_file] = bytearray()
+                open(output_file, "ab" if append else "wb").close()
+
+    def _get_fh(self, output_file: str):
+        '''Returns an open filehandler for an output file, opening it in append mode (and closing the least recently written file, if too many are open) if needed.'''
+        # local variables
+        fh = None
+
+        if output_file in self.open_fh_dict:
+            self.open_fh_dict.move_to_end(output_file)
+            return self.open_fh_dict[output_file]
+        while len(self.open_fh_dict) >= self.max_open_files:
+            self._close_fh(self.open_fh_dict.popitem(last=False)[1])
+        if self.compress:
+            fh = BgzfWriter(output_file, "ab", self.compress_level, self.executor)
+        else:
+            fh = open(output_file, "ab")
+        self.open_fh_dict[output_file] = fh
+        return fh
+
+    def _close_fh(self, fh):
+        '''Closes an output filehandler. BGZF files don't get their end-of-file marker here, since more data may get appended to them later (see close).'''
+        if self.compress:
+            fh.close(write_eof=False)
+        else:
+            fh.close()
+
+    def _write_buffer(self, output_file: str):
+        '''Writes out (and empties) the buffer of one output file. BGZF files are flushed right away (see the class docstring), so nothing stays in their writers.'''
+        if len(self.buffers_dict[output_file]) == 0:
+            return
+        self._get_fh(output_file).write(self.buffers_dict[output_file])
+        if self.compress:
+            self._get_fh(output_file).flush()
+        self.buffered_bytes -= len(self.buffers_dict[output_file])
+        self.buffers_dict[output_file] = bytearray()
+
+    def write(self, bucket: str, read1_data: bytes, read2_data: bytes):
+        '''Adds read1/read2 FASTQ data (whole records) to the output files of a bucket.'''
+        # local variables
+        output_file: str = ""
+
+        for output_file, data in zip(self.output_files_dict[bucket], [read1_data, read2_data]):
+            self.buffers_dict[output_file] += data
+            self.buffered_bytes += len(data)
+
+        if self.buffered_bytes > self.buffer_bytes:
+            #write out the largest buffers first, so each write is as large as possible
+            for output_file in sorted(self.buffers_dict, key=lambda output_file: len(self.buffers_dict[output_file]), reverse=True):
+                if self.buffered_bytes <= self.buffer_bytes // 2:
+                    break
+                self._write_buffer(output_file)
+
+    def flush(self):
+        '''Writes out all buffers and flushes all open output files.'''
+        for output_file in self.buffers_dict:
+            self._write_buffer(output_file)
+        for fh in self.open_fh_dict.values():
+            fh.flush()
+
+    def get_output_sizes(self) -> dict:
+        '''Returns a dictionary with keys: output filenames, values: current size of each file in bytes. Only includes data that has been written out (see flush).'''
+        return {output_file: os.path.getsize(output_file) for output_file in self.buffers_dict}
+
+    def close(self):
+        '''Writes out all buffers and closes all output files. BGZF files get their end-of-file marker block.'''
+        if self.is_closed:
+            return
+        self.flush()
+        while len(self.open_fh_dict) > 0:
+            self._close_fh(self.open_fh_dict.popitem(last=False)[1])
+        if self.compress:
+            for output_file in self.buffers_dict:
+                with open(output_file, "ab") as fh:
+                    fh.write(BGZF_EOF_BLOCK)
+        self.is_closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FifoBucketWriter:
+    '''Writes demultiplexed read-pairs to named pipes (FIFOs) instead of regular files, so the next tool (aligner, trimmer, ...) can read each bucket's read1/read2 files as they're produced, without the reads touching the disk.
+    Each output file in output_files_dict is created as a FIFO (an existing FIFO is reused) and gets its own writer thread fed by a queue holding at most queue_size blocks.
+    Read1 and read2 are written independently, so a reader that reads both files of a bucket in step can't deadlock; once a queue is full, write() blocks until the reader catches up (backpressure).
+    Opening a FIFO waits for a reader, so every output file needs a reader (e.g. cat > /dev/null for unwanted buckets) or the run will stall once that bucket's queue fills up.
+    The FIFOs are removed by close(), or by remove_fifos() if the run fails or is interrupted before it can close them (remove_fifos is also registered with atexit, as a last resort).'''
+
+    def __init__(self, output_files_dict: dict, queue_size: int = 16):
+        self.output_files_dict: dict = output_files_dict
+        self.queues_dict: dict = {}     #keys: output filenames, values: queue of blocks to write to that FIFO, then None to close it
+        self.threads_list: list = []
+        self.error = None               #exception raised by a writer thread (e.g. BrokenPipeError if a reader exits early)
+        self.is_closed: bool = False
+
+        for bucket in output_files_dict:
+            for output_file in output_files_dict[bucket]:
+                if not os.path.exists(output_file):
+                    os.mkfifo(output_file)
+                elif not stat.S_ISFIFO(os.stat(output_file).st_mode):
+                    raise FileExistsError(output_file + " already exists and isn't a named pipe")
+                self.queues_dict[output_file] = queue.Queue(maxsize=queue_size)
+                self.threads_list.append(threading.Thread(target=self._write_fifo, args=(output_file,), name="fifo " + output_file, daemon=True))
+                self.threads_list[-1].start()
+        atexit.register(self.remove_fifos)
+
+    def _write_fifo(self, output_file: str):
+        '''Runs on a writer thread: opens one FIFO (waiting for a reader) and writes the blocks from its queue to it until it gets None.'''
+        # local variables
+        data = None
+        is_done: bool = False   #True once the None at the end of the queue has been taken
+
+        try:
+            with open(output_file, "wb") as fifo_fh:
+                while True:
+                    data = self.queues_dict[output_file].get()
+                    if data is None:
+                        is_done = True
+                        break
+                    fifo_fh.write(data)
+        except Exception as err:    #hand errors to the main thread, so they aren't lost on this thread
+            self.error = err
+            #keep emptying the queue, so the main thread doesn't block on a FIFO nobody is reading any more
+            while not is_done:
+                is_done = self.queues_dict[output_file].get() is None
+
+    def write(self, bucket: str, read1_data: bytes, read2_data: bytes):
+        '''Queues read1/read2 FASTQ data (whole records) for the FIFOs of a bucket. Blocks if either queue is full.'''
+        if self.error is not None:
+            raise self.error
+        for output_file, data in zip(self.output_files_dict[bucket], [read1_data, read2_data]):
+            if len(data) > 0:
+                self.queues_dict[output_file].put(data)
+
+    def flush(self):
+        '''Nothing to do: queued data is written by the writer threads as fast as the readers take it.'''
+        pass
+
+    def get_output_sizes(self) -> dict:
+        '''FIFOs have no size to go back to, so a run writing to them can't be checkpointed. Returns an empty dictionary.'''
+        return {}
+
+    def close(self):
+        '''Waits for all queued data to be written, closes every FIFO (so its reader sees the end of the file), and removes the FIFOs.'''
+        if self.is_closed:
+            return
+        self.is_closed = True
+        for fifo_queue in self.queues_dict.values():
+            fifo_queue.put(None)
+        for thread in self.threads_list:
+            thread.join()
+        self.remove_fifos()
+        if self.error is not None:
+            raise self.error
+
+    def remove_fifos(self):
+        '''Removes the FIFOs without waiting for queued data to be written, for a run that failed or was interrupted (readers see the end of their file once the writer threads exit with the process).
+        FIFOs that are already gone are skipped, so this can be called more than once.'''
+        for output_file in self.queues_dict:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class InterleavedBucketWriter:
+    '''Writes the read-pairs of a single bucket to one binary stream (e.g. sys.stdout.buffer) as interleaved paired FASTQ: read1 record, read2 record, read1 record, ...
+    Read-pairs in every other bucket are dropped. Writes block when the reader of the stream falls behind (backpressure).'''
+
+    def __init__(self, bucket: str, output_fh):
+        self.bucket: str = bucket
+        self.output_fh = output_fh
+
+    def write(self, bucket: str, read1_data: bytes, read2_data: bytes):
+        '''Writes read1/read2 FASTQ data (whole records, the same read-pairs in the same order) as interleaved records, if it belongs to the selected bucket.'''
+        # local variables
+        read1_lines: list = []
+        read2_lines: list = []
+        interleaved_lines: list = []
+
+        if bucket != self.bucket or len(read1_data) == 0:
+            return
+        read1_lines = read1_data.split(b"\n")[:-1]     #data ends with "\n", so the last split is empty
+        read2_lines = read2_data.split(b"\n")[:-1]
+        #take 4 lines (1 record) from each file in turn
+        for r in range(0, len(read1_lines), 4):
+            interleaved_lines.extend(read1_lines[r:r + 4])
+            interleaved_lines.extend(read2_lines[r:r + 4])
+        self.output_fh.write(b"\n".join(interleaved_lines) + b"\n")
+
+    def flush(self):
+        '''Flushes the output stream.'''
+        self.output_fh.flush()
+
+    def get_output_sizes(self) -> dict:
+        '''A stream has no size to go back to, so a run writing to one can't be checkpointed. Returns an empty dictionary.'''
+        return {}
+
+    def close(self):
+        '''Flushes the output stream. The stream itself is left open, since it belongs to the caller.'''
+        self.output_fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CallbackBucketWriter:
+    '''Hands demultiplexed read-pairs to a function instead of writing them anywhere, for using demux.parse_input_files as a library: callback(bucket, read1 data, read2 data) is called
+    with whole FASTQ records (bytes) for every bucket of every batch, in input order. The callback runs on the main thread, so demultiplexing waits while it runs (backpressure).'''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, bucket: str, read1_data: bytes, read2_data: bytes):
+        '''Calls the callback with read1/read2 FASTQ data of a bucket.'''
+        self.callback(bucket, read1_data, read2_data)
+
+    def flush(self):
+        pass
+
+    def get_output_sizes(self) -> dict:
+        '''Returns an empty dictionary: data handed to a callback can't be taken back, so a run using one can't be checkpointed.'''
+        return {}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,70 @@
+#!/bin/python
+'''Run-time instrumentation for demux.py: cumulative per-stage timers and counters, periodic JSON-lines progress reports, and a final summary.'''
+import json     #needed to write progress reports and the summary as JSON
+import time     #needed for the timers
+
+class RunMetrics:
+    '''Keeps cumulative timers (seconds spent in each stage of the demultiplexing loop, e.g. "read", "classify", "write") and counters (e.g. records, bytes) for a run.
+    report_progress() writes a JSON line with the totals and the records/sec and bytes/sec since the previous report to progress_fh, at most once every interval_seconds.'''
+
+    def __init__(self, progress_fh = None, interval_seconds: float = 60, labels: dict = None):
+        self.progress_fh = progress_fh      #file object progress lines are written to, or None for no progress lines
+        self.labels_dict: dict = dict(labels) if labels else {}     #added to every progress line and the summary, e.g. {"lane": lane name} so lanes running at the same time can be told apart
+        self.interval_seconds: float = interval_seconds
+        self.start_time: float = time.perf_counter()
+        self.stage_seconds_dict: dict = {}  #keys: stage names, values: total seconds spent in that stage
+        self.counters_dict: dict = {}       #keys: counter names, values: totals
+        self.last_report_time: float = self.start_time
+        self.last_report_counters_dict: dict = {}   #counters at the time of the previous progress line
+
+    def add_time(self, stage: str, seconds: float):
+        '''Adds seconds to a stage's timer.'''
+        self.stage_seconds_dict[stage] = self.stage_seconds_dict.get(stage, 0) + seconds
+
+    def set_time(self, stage: str, seconds: float):
+        '''Sets a stage's timer (for totals kept somewhere else, e.g. time spent on the input decompression threads).'''
+        self.stage_seconds_dict[stage] = seconds
+
+    def add_count(self, counter: str, amount: int):
+        '''Adds an amount to a counter.'''
+        self.counters_dict[counter] = self.counters_dict.get(counter, 0) + amount
+
+    def set_count(self, counter: str, value: int):
+        '''Sets a counter to a value (for totals kept somewhere else, e.g. bytes read by the input threads).'''
+        self.counters_dict[counter] = value
+
+    def get_snapshot(self) -> dict:
+        '''Returns a dictionary of elapsed seconds, stage timers, counters, and overall records/sec and bytes/sec.'''
+        # local variables
+        elapsed_seconds: float = time.perf_counter() - self.start_time
+
+        return {
+            **self.labels_dict,
+            "elapsed_seconds": round(elapsed_seconds, 3),
+            "records": self.counters_dict.get("records", 0),
+            "records_per_sec": round(self.counters_dict.get("records", 0) / max(elapsed_seconds, 1e-9), 1),
+            "bytes_per_sec": round(self.counters_dict.get("input_bytes", 0) / max(elapsed_seconds, 1e-9), 1),
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in self.stage_seconds_dict.items()},
+            "counters": dict(self.counters_dict)
+            }
+
+    def report_progress(self, force: bool = False):
+        '''Writes a JSON progress line if interval_seconds have passed since the previous one (or if force is True). Rates in the line cover the time since the previous line.'''
+        # local variables
+        now: float = time.perf_counter()
+        progress_dict: dict = {}
+
+        if self.progress_fh is None or (not force and now - self.last_report_time < self.interval_seconds):
+            return
+        progress_dict = self.get_snapshot()
+        progress_dict["interval_records_per_sec"] = round((self.counters_dict.get("records", 0) - self.last_report_counters_dict.get("records", 0)) / max(now - self.last_report_time, 1e-9), 1)
+        progress_dict["interval_bytes_per_sec"] = round((self.counters_dict.get("input_bytes", 0) - self.last_report_counters_dict.get("input_bytes", 0)) / max(now - self.last_report_time, 1e-9), 1)
+        self.progress_fh.write(json.dumps(progress_dict) + "\n")
+        self.progress_fh.flush()
+        self.last_report_time = now
+        self.last_report_counters_dict = dict(self.counters_dict)
+
+    def write_summary(self, summary_filename: str):
+        '''Writes the final totals (see get_snapshot) to a JSON file.'''
+        with open(summary_filename, "w") as summary_fh:
+            json.dump(self.get_snapshot(), summary_fh, indent=1)
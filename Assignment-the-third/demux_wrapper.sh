@@ -16,6 +16,6 @@ index1_file="/projects/bgmp/shared/2017_sequencing/1294_S1_L008_R2_001.fastq.gz"
 index2_file="/projects/bgmp/shared/2017_sequencing/1294_S1_L008_R3_001.fastq.gz"
 ref_indexes_file="/projects/bgmp/shared/2017_sequencing/indexes.txt"
 
-/usr/bin/time -v python $script_file -r $read1_file $read2_file -i $index1_file $index2_file -t $ref_indexes_file
+/usr/bin/time -v python $script_file -r $read1_file $read2_file -i $index1_file $index2_file -t $ref_indexes_file -w $SLURM_CPUS_PER_TASK
 
 exit
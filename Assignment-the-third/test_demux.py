@@ -0,0 +1,115 @@
+#!/bin/python
+'''End-to-end checks of demux.py on the test FASTQ files in TEST-input_FASTQ: the unit test files against the expected outputs in TEST-output_FASTQ,
+the same output for any number of workers, and a run killed part way through and continued with --resume giving the same output as a clean run.
+Run with: python -m pytest test_demux.py (or python test_demux.py)'''
+import json     #needed to read the stats and checkpoint files
+import os
+import signal   #needed to kill a run part way through
+import subprocess   #needed to run demux.py like a user would
+import sys
+import tempfile     #needed for a scratch directory for each run's output
+import time     #needed to wait for a run's first checkpoint
+import demux_benchmark  #the 24 reference indexes from indexes.txt on Talapas
+
+DEMUX_SCRIPT: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "demux.py")
+TEST_INPUT_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TEST-input_FASTQ")
+TEST_OUTPUT_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TEST-output_FASTQ")
+#4 read-pairs covering every bucket type: dual matched, index-hopped, unknown/low quality
+UNIT_TEST_FILES: list = [os.path.join(TEST_INPUT_DIR, filename) for filename in ["unit_test_read_1.fq.gz", "unit_test_read_2.fq.gz", "unit_test_index_1.fq.gz", "unit_test_index_2.fq.gz"]]
+#250,000 index read-pairs, used as both the biological reads and the indexes, so runs have many batches and checkpoints
+MILL_TEST_FILES: list = [os.path.join(TEST_INPUT_DIR, filename) for filename in ["mill_unit_test_index_1.fq.gz", "mill_unit_test_index_2.fq.gz", "mill_unit_test_index_1.fq.gz", "mill_unit_test_index_2.fq.gz"]]
+
+def get_demux_command(input_files: list, output_dir: str, options: list) -> list:
+    '''Returns the command line that runs demux.py on 4 input files (read1, read2, index1, index2) with the 24 reference indexes, writing an indexes file to output_dir for it.'''
+    # local variables
+    indexes_filename: str = os.path.join(output_dir, "indexes.txt")
+
+    with open(indexes_filename, "w") as indexes_fh:
+        indexes_fh.write("sample\tgroup\ttreatment\tindex\tindex sequence\n")
+        for sample_num, (index_name, index_seq) in enumerate(demux_benchmark.DEFAULT_INDEXES):
+            indexes_fh.write(str(sample_num + 1) + "\ttest\ttest\t" + index_name + "\t" + index_seq + "\n")
+    return [sys.executable, DEMUX_SCRIPT, "-r", input_files[0], input_files[1], "-i", input_files[2], input_files[3], "-t", indexes_filename, "--no-report", "--metrics-interval", "0"] + options
+
+def run_demux(input_files: list, output_dir: str, options: list):
+    '''Runs demux.py to the end in output_dir (see get_demux_command), failing the check if it exits with an error.'''
+    subprocess.run(get_demux_command(input_files, output_dir, options), cwd=output_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def get_run_output(output_dir: str) -> dict:
+    '''Returns a dictionary with keys: output FASTQ filenames, values: their contents, plus "record_counters" and "index_pair_matrix" from the run's stats file.'''
+    # local variables
+    output_dict: dict = {}
+    stats_dict: dict = {}
+
+    for filename in sorted(os.listdir(output_dir)):
+        if filename.endswith(".fq"):
+            with open(os.path.join(output_dir, filename), "rb") as output_fh:
+                output_dict[filename] = output_fh.read()
+    with open(os.path.join(output_dir, "demux_stats.json"), "r") as stats_fh:
+        stats_dict = json.load(stats_fh)
+    output_dict["record_counters"] = stats_dict["record_counters"]
+    output_dict["index_pair_matrix"] = stats_dict["index_pair_matrix"]
+    return output_dict
+
+def get_records_without_tags(fastq_data: bytes) -> list:
+    '''Returns the lines of FASTQ data with the index tag (" index1-index2") taken off each header line.
+    The expected outputs were written by hand before demux.py, and their swapped record's tag has the reverse complement of index2 instead of index2 as read, so tags aren't compared.'''
+    # local variables
+    lines_list: list = fastq_data.decode("ascii").rstrip("\n").split("\n")
+
+    return [line.rsplit(" ", 1)[0] if line_num % 4 == 0 else line for line_num, line in enumerate(lines_list)]
+
+def test_unit_test_files_match_expected_output():
+    '''Each read-pair of the unit test files ends up in the bucket TEST-output_FASTQ expects it in, unchanged apart from its header tag.'''
+    # local variables
+    expected_buckets_dict: dict = {"B1": "B1", "swapped": "swapped", "unmatched_lowQ": "unknown_lowQ"}   #keys: bucket names in TEST-output_FASTQ, values: bucket names demux.py uses
+    expected_data: bytes = b""
+    output_data: bytes = b""
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        run_demux(UNIT_TEST_FILES, output_dir, [])
+        for expected_bucket, bucket in expected_buckets_dict.items():
+            for read_num in [1, 2]:
+                with open(os.path.join(TEST_OUTPUT_DIR, "output_unit_test_read" + str(read_num) + "_" + expected_bucket + ".fq"), "rb") as expected_fh:
+                    expected_data = expected_fh.read()
+                with open(os.path.join(output_dir, bucket + "_unit_test_read_" + str(read_num) + ".fq"), "rb") as output_fh:
+                    output_data = output_fh.read()
+                assert get_records_without_tags(output_data) == get_records_without_tags(expected_data), bucket + " read" + str(read_num)
+
+def test_workers_give_same_output():
+    '''Output files and stats are identical with 1 worker and with several, including when batches are small enough that every worker gets many of them.'''
+    for input_files, options, workers_list in [(UNIT_TEST_FILES, ["--batch-size", "1"], ["2", "3"]), (MILL_TEST_FILES, ["--batch-size", "997"], ["2", "4"])]:
+        with tempfile.TemporaryDirectory() as single_dir:
+            run_demux(input_files, single_dir, options + ["-w", "1"])
+            for workers in workers_list:
+                with tempfile.TemporaryDirectory() as workers_dir:
+                    run_demux(input_files, workers_dir, options + ["-w", workers])
+                    assert get_run_output(workers_dir) == get_run_output(single_dir), "-w " + workers
+
+def test_killed_run_resumes_to_same_output():
+    '''A run killed (SIGKILL) after its first checkpoint and then continued with --resume gives the same output and stats as a run that was never interrupted, with 1 worker and with workers writing the output.'''
+    # local variables
+    options: list = ["--batch-size", "2000", "--checkpoint-every", "10000", "--buffer-size-mb", "1"]
+    demux_process = None
+    checkpoint_dict: dict = {}
+
+    with tempfile.TemporaryDirectory() as clean_dir:
+        run_demux(MILL_TEST_FILES, clean_dir, options)
+        for workers in ["1", "2"]:
+            with tempfile.TemporaryDirectory() as resumed_dir:
+                demux_process = subprocess.Popen(get_demux_command(MILL_TEST_FILES, resumed_dir, options + ["-w", workers]), cwd=resumed_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                while not os.path.exists(os.path.join(resumed_dir, "demux_checkpoint.json")) and demux_process.poll() is None:
+                    time.sleep(0.005)
+                demux_process.send_signal(signal.SIGKILL)
+                assert demux_process.wait() == -signal.SIGKILL, "run finished before it could be killed"
+                with open(os.path.join(resumed_dir, "demux_checkpoint.json"), "r") as checkpoint_fh:
+                    checkpoint_dict = json.load(checkpoint_fh)
+                assert 0 < checkpoint_dict["records_done"] < 250000
+                run_demux(MILL_TEST_FILES, resumed_dir, options + ["-w", workers, "--resume"])
+                assert get_run_output(resumed_dir) == get_run_output(clean_dir), "-w " + workers
+
+
+if __name__ == "__main__":
+    test_unit_test_files_match_expected_output()
+    test_workers_give_same_output()
+    test_killed_run_resumes_to_same_output()
+    print("all checks passed")